@@ -1,9 +1,12 @@
+import torch
 from torchvision import transforms
 
 from .tiny_images import TinyImages
 from .ti_300k import TI300K
 from .imagenet_64 import ImageNet64
 from .named_dataset_with_meta import NamedDatasetWithMeta
+from .transform_view import TransformView
+from .cuda_prefetcher import CUDAPrefetcher
 
 CIFAR100_CLASSES = [
     'apple', 'aquarium_fish', 'baby', 'bear', 'beaver', 'bed', 'bee', 'beetle', 'bicycle', 'bottle', 
@@ -135,3 +138,26 @@ def get_ood_trf(ds_name_id, ds_name_ood, stage):
         raise Exception('---> Dataset Stage: {} invalid'.format(stage))
 
     return transforms.Compose(ood_trf[ds_name_ood])
+
+def cache_gpu_batches(data_loader):
+    # only for deterministic (test transform) loaders: load & transform once, then replay the GPU resident batches
+    num_sample = len(data_loader.sampler)
+    data, label = None, None
+
+    idx = 0
+    for sample in data_loader:
+        num = sample['data'].size(0)
+        if data is None:
+            data = torch.empty((num_sample,) + tuple(sample['data'].shape[1:]), device='cuda', memory_format=torch.channels_last)
+            # unlabeled sets (auxiliary OOD) only carry data
+            if 'label' in sample:
+                label = torch.empty(num_sample, dtype=torch.long, device='cuda')
+        data[idx:idx+num] = sample['data'].cuda(non_blocking=True)
+        if label is not None:
+            label[idx:idx+num] = sample['label'].cuda(non_blocking=True)
+        idx += num
+
+    batch_size = data_loader.batch_size
+    if label is None:
+        return [{'data': data[i:i+batch_size]} for i in range(0, num_sample, batch_size)]
+    return [{'data': data[i:i+batch_size], 'label': label[i:i+batch_size]} for i in range(0, num_sample, batch_size)]
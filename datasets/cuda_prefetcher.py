@@ -0,0 +1,42 @@
+'''
+Overlap host to device copies of the next batch with the compute on the current one
+'''
+
+import torch
+
+class CUDAPrefetcher:
+
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.data_loader)
+        sample = self._preload(loader_iter)
+
+        while sample is not None:
+            # the copy of this batch must be done before compute uses it, and its memory must not be
+            # recycled by the side stream's allocator while compute on the default stream still reads it
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            for v in sample.values():
+                if torch.is_tensor(v):
+                    v.record_stream(current_stream)
+
+            next_sample = self._preload(loader_iter)
+            yield sample
+            sample = next_sample
+
+    def _preload(self, loader_iter):
+        try:
+            sample = next(loader_iter)
+        except StopIteration:
+            return None
+
+        # image batches are also converted to channels_last here, so the layout copy overlaps with compute too
+        with torch.cuda.stream(self.stream):
+            sample = {k: v.cuda(non_blocking=True) if torch.is_tensor(v) else v for k, v in sample.items()}
+            return {k: v.to(memory_format=torch.channels_last) if torch.is_tensor(v) and v.dim() == 4 else v for k, v in sample.items()}
@@ -25,7 +25,8 @@ class TinyImages(Dataset):
             data_file_path = data_dir / 'tiny_images.bin'
             self.num = 79302017
 
-        self.data_file = open(data_file_path, 'rb')
+        # memory map the raw file, images are read without seek / read syscalls or a shared file offset across workers
+        self.data = np.memmap(data_file_path, dtype=np.uint8, mode='r', shape=(self.num, 3, 32, 32))
         self.transform = transform
 
     def __getitem__(self, index):
@@ -44,13 +45,5 @@ class TinyImages(Dataset):
         return self.num
 
     def _load_image(self, idx):
-        self.data_file.seek(idx * 3072)
-        data = self.data_file.read(3072)
-
-        try:
-            result = np.fromstring(data, dtype='uint8').reshape(32, 32, 3, order='F')
-        except ValueError:
-            print(idx)
-            exit()
-        else:
-            return result
+        # images are stored column-major as [32, 32, 3]
+        return np.ascontiguousarray(self.data[idx].transpose(2, 1, 0))
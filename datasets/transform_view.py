@@ -0,0 +1,25 @@
+'''
+Per-view transform over a dataset loaded once without one
+'''
+
+from torch.utils.data import Dataset
+
+class TransformView(Dataset):
+
+    def __init__(self, base, transform=None):
+        # base is built with transform=None so several views share the loaded images
+        self.base = base
+        self.transform = transform
+
+    def __getitem__(self, index):
+        sample = self.base[index]
+
+        if self.transform is not None:
+            # shallow copy, a base that hands out cached samples must not see this view's transform
+            sample = dict(sample)
+            sample['data'] = self.transform(sample['data'])
+
+        return sample
+
+    def __len__(self):
+        return len(self.base)
@@ -7,7 +7,6 @@ import numpy as np
 from pathlib import Path
 from functools import partial
 import matplotlib.pyplot as plt
-from sklearn.covariance import EmpiricalCovariance
 # import sklearn.covariance
 
 import torch
@@ -16,23 +15,26 @@ import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 
 from models import get_clf
-from utils import compute_all_metrics
+from trainers import get_amp
+from utils import compute_all_metrics, unwrap_state_dict
 from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds
 
 def get_msp_score(data_loader, clf):
     clf.eval()
 
-    msp_score = []
+    msp_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
 
             prob = torch.softmax(logit, dim=1)
-            msp_score.extend(torch.max(prob, dim=1)[0].tolist())
+            msp_score[idx:idx+data.size(0)] = torch.max(prob, dim=1)[0]
+            idx += data.size(0)
 
-    return msp_score
+    return msp_score.cpu().numpy()
 
 def get_abs_score(data_loader, clf):
     '''
@@ -40,38 +42,43 @@ def get_abs_score(data_loader, clf):
     '''
     clf.eval()
 
-    abs_score = []
+    abs_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
 
             prob = torch.softmax(logit, dim=1)
-            abs_score.extend(prob[:, -1].tolist())
+            abs_score[idx:idx+data.size(0)] = prob[:, -1]
+            idx += data.size(0)
 
-    return [1 - abs for abs in abs_score]
+    return 1 - abs_score.cpu().numpy()
 
 def get_logit_score(data_loader, clf):
     clf.eval()
 
-    logit_score = []
+    logit_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
-            logit_score.extend(torch.max(logit, dim=1)[0].tolist())
+            logit_score[idx:idx+data.size(0)] = torch.max(logit, dim=1)[0]
+            idx += data.size(0)
 
-    return logit_score
+    return logit_score.cpu().numpy()
 
 def get_odin_score(data_loader, clf, temperature=1000.0, magnitude=0.0014, std=(0.2470, 0.2435, 0.2616)):
     clf.eval()
     
-    odin_scores = []
+    odin_scores = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
         
         data.requires_grad = True
         logit = clf(data)
@@ -97,100 +104,117 @@ def get_odin_score(data_loader, clf, temperature=1000.0, magnitude=0.0014, std=(
         nnOutput = nnOutput - nnOutput.max(dim=1, keepdims=True).values
         nnOutput = nnOutput.exp() / nnOutput.exp().sum(dim=1, keepdims=True)
         
-        odin_scores.extend(nnOutput.max(dim=1)[0].tolist())
+        odin_scores[idx:idx+data.size(0)] = nnOutput.max(dim=1)[0]
+        idx += data.size(0)
     
-    return odin_scores
+    return odin_scores.cpu().numpy()
+
+def stable_cholesky(cov, eps=1e-6, max_tries=8):
+    # rank-deficient covariances (dead / constant ReLU features, fewer samples than dims) are not positive definite,
+    # add a diagonal jitter relative to the mean variance and grow it until the factorization succeeds
+    cov_cholesky, info = torch.linalg.cholesky_ex(cov)
+    if info.item() == 0:
+        return cov_cholesky
+
+    eye = torch.eye(cov.size(0), dtype=cov.dtype, device=cov.device)
+    # jitter relative to the mean variance (trace / dim), absolute if every feature is constant
+    scale = cov.diagonal().mean().item()
+    jitter = eps * (scale if scale > 0 else 1.0)
+    for _ in range(max_tries):
+        cov_cholesky, info = torch.linalg.cholesky_ex(cov + jitter * eye)
+        if info.item() == 0:
+            print('>>> covariance is singular, regularized with jitter {:.3e}'.format(jitter))
+            return cov_cholesky
+        jitter = jitter * 10
+
+    raise RuntimeError('<<< Covariance is not positive definite even with jitter {:.3e}'.format(jitter))
 
 def sample_estimator(data_loader, clf, num_classes):
     clf.eval()
-    group_lasso = EmpiricalCovariance(assume_centered=False)
 
-    num_sample_per_class = np.zeros(num_classes)
-    list_features = [0] * num_classes
+    num_sample = len(data_loader.sampler)
+    feats = None
+    targets = torch.empty(num_sample, dtype=torch.long, device='cuda')
 
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
-        target = sample['label'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = sample['label'].cuda(non_blocking=True)
+        num = data.size(0)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             _, penulti_feature = clf(data, ret_feat=True)
 
         # construct the sample matrix
-        for i in range(target.size(0)):
-            label = target[i]
-            if num_sample_per_class[label] == 0:
-                list_features[label] = penulti_feature[i].view(1, -1)
-            else:
-                list_features[label] = torch.cat((list_features[label], penulti_feature[i].view(1, -1)), 0)
-            num_sample_per_class[label] += 1
-
-    category_sample_mean = []
-    for j in range(num_classes):
-        category_sample_mean.append(torch.mean(list_features[j], 0))
-
-    X = 0
-    for j in range(num_classes):
-        if j == 0:
-            X = list_features[j] - category_sample_mean[j]
-        else:
-            X = torch.cat((X, list_features[j] - category_sample_mean[j]), 0)
-        
-        # find inverse
-    group_lasso.fit(X.cpu().numpy())
-    precision = group_lasso.precision_
+        if feats is None:
+            feats = torch.empty(num_sample, penulti_feature.size(1), device='cuda')
+        feats[idx:idx+num] = penulti_feature
+        targets[idx:idx+num] = target
+        idx += num
+
+    # class means by scatter-add instead of per-sample concatenation
+    num_sample_per_class = torch.bincount(targets, minlength=num_classes)
+    category_sample_mean = torch.zeros(num_classes, feats.size(1), device='cuda').index_add_(0, targets, feats)
+    category_sample_mean /= num_sample_per_class.unsqueeze(1)
+
+    # class-centered features already have zero column mean, no second centering is needed
+    X = feats.sub_(category_sample_mean[targets]).double()
+
+    # empirical covariance on GPU (in double like sklearn), then its lower cholesky factor instead of the explicit inverse
+    cov = torch.mm(X.t(), X).div_(X.size(0))
+    cov_cholesky = stable_cholesky(cov)
     
-    return category_sample_mean, torch.from_numpy(precision).float().cuda()
+    return category_sample_mean, cov_cholesky.float()
 
-def get_mahalanobis_score(data_loader, clf, num_classes, sample_mean, precision):
+def get_mahalanobis_score(data_loader, clf, sample_mean, cov_cholesky):
     '''
     Negative mahalanobis distance to the cloest class center
     '''
     clf.eval()
 
-    nm_score = []
+    nm_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             _, penul_feat = clf(data, ret_feat=True)
+            penul_feat = penul_feat.float()
 
-        term_gaus = torch.empty(0)
-        for j in range(num_classes):
-            category_sample_mean = sample_mean[j]
-            zero_f = penul_feat - category_sample_mean
-            # term_gau = torch.exp(-0.5 * torch.mm(torch.mm(zero_f, precision), zero_f.t()).diag()) # [BATCH,]
-            term_gau = -0.5 * torch.mm(torch.mm(zero_f, precision), zero_f.t()).diag() # [BATCH, ]
-            if j == 0:
-                term_gaus = term_gau.view(-1, 1)
-            else:
-                term_gaus = torch.cat((term_gaus, term_gau.view(-1, 1)), dim=1)
+            # distances to all class centers at once, (x - mu)^T S^-1 (x - mu) = ||L^-1 (x - mu)||^2
+            zero_f = penul_feat.unsqueeze(1) - sample_mean.unsqueeze(0) # [BATCH, CLASS, DIM]
+            white_f = torch.linalg.solve_triangular(cov_cholesky, zero_f.reshape(-1, zero_f.size(2)).t(), upper=False) # [DIM, BATCH * CLASS]
+            term_gaus = -0.5 * white_f.pow(2).sum(dim=0).view(zero_f.size(0), zero_f.size(1)) # [BATCH, CLASS]
 
-        nm_score.extend(torch.max(term_gaus, dim=1)[0].tolist())
+        nm_score[idx:idx+data.size(0)] = torch.max(term_gaus, dim=1)[0]
+        idx += data.size(0)
 
-    return nm_score
+    return nm_score.cpu().numpy()
 
 def get_energy_score(data_loader, clf, temperature=1.0):
     clf.eval()
     
-    energy_score = []
+    energy_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
 
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
         
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
-            energy_score.extend((temperature * torch.logsumexp(logit / temperature, dim=1)).tolist())
+            energy_score[idx:idx+data.size(0)] = temperature * torch.logsumexp(logit / temperature, dim=1)
+            idx += data.size(0)
     
-    return energy_score
+    return energy_score.cpu().numpy()
 
 def get_acc(data_loader, clf, num_classes):
     clf.eval()
     correct, total = 0, 0
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for sample in data_loader:
-            data = sample['data'].cuda()
-            target = sample['label'].cuda()
+            data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            target = sample['label'].cuda(non_blocking=True)
 
             logit = clf(data)
 
@@ -238,7 +262,7 @@ def main(args):
     if clf_path.is_file():
         clf_state = torch.load(str(clf_path))
         cla_acc = clf_state['cla_acc']
-        clf.load_state_dict(clf_state['state_dict'])
+        clf.load_state_dict(unwrap_state_dict(clf_state['state_dict']))
         print('>>> load classifier from {} (classification acc {:.4f}%)'.format(str(clf_path), cla_acc))
     else:
         raise RuntimeError('<--- invlaid classifier path: {}'.format(str(clf_path)))
@@ -247,22 +271,41 @@ def main(args):
     gpu_idx = int(args.gpu_idx)
     if torch.cuda.is_available():
         torch.cuda.set_device(gpu_idx)
-        clf.cuda()
+        clf.cuda().to(memory_format=torch.channels_last)
         torch.cuda.manual_seed(args.seed)
     cudnn.benchmark = False
 
     # get_acc(test_loader_id, clf, num_classes)
 
+    # scoring is inference only, low precision forward passes are enough for ranking
+    amp_dtype, _ = get_amp(args.amp)
     get_score = score_dic[args.score]
     if args.score == 'maha':
-        train_set_id_test = get_ds(root=args.data_dir, ds_name=args.id, split='train', transform=test_trf_id)
-        train_loader_id_test = DataLoader(train_set_id_test, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
-        cat_mean, precision = sample_estimator(train_loader_id_test, clf, num_classes)
+        # the estimator only depends on the CLF, the ID train set & the autocast dtype, cache it next to the checkpoint
+        estimator_path = clf_path.with_suffix('.{}.{}.maha'.format(args.id, args.amp))
+        estimator = {}
+        if not args.refresh_estimator and estimator_path.is_file() and estimator_path.stat().st_mtime >= clf_path.stat().st_mtime:
+            estimator = torch.load(str(estimator_path))
+        if 'cov_cholesky' in estimator:
+            cat_mean, cov_cholesky = estimator['sample_mean'], estimator['cov_cholesky']
+            print('>>> load estimator from {}'.format(str(estimator_path)))
+        else:
+            train_set_id_test = get_ds(root=args.data_dir, ds_name=args.id, split='train', transform=test_trf_id)
+            train_loader_id_test = DataLoader(train_set_id_test, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                cat_mean, cov_cholesky = sample_estimator(train_loader_id_test, clf, num_classes)
+            # the checkpoint directory may be read-only, the cache is only an optimization
+            try:
+                torch.save({
+                    'sample_mean': cat_mean,
+                    'cov_cholesky': cov_cholesky
+                }, str(estimator_path))
+            except OSError as e:
+                print('<<< could not cache estimator to {}: {}'.format(str(estimator_path), e))
         get_score = partial(
             score_dic['maha'],
-            num_classes=num_classes, 
             sample_mean=cat_mean, 
-            precision=precision
+            cov_cholesky=cov_cholesky
         )
     elif args.score == 'odin':
         get_score = partial(
@@ -273,7 +316,8 @@ def main(args):
         )
     else:
         get_score = score_dic[args.score]
-    score_id = get_score(test_loader_id, clf)
+    with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+        score_id = get_score(test_loader_id, clf)
     label_id = np.ones(len(score_id))
 
     # visualize the confidence distribution
@@ -284,7 +328,8 @@ def main(args):
         # result_dic = {'name': test_loader_ood.dataset.name}
         ood_names.append(test_loader_ood.dataset.name)
 
-        score_ood = get_score(test_loader_ood, clf)
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+            score_ood = get_score(test_loader_ood, clf)
         label_ood = np.zeros(len(score_ood))
 
         # OOD detection
@@ -344,6 +389,8 @@ if __name__ == '__main__':
     parser.add_argument('--arch', type=str, default='densenet101', choices=['densenet101', 'wrn40'])
     parser.add_argument('--pretrain', type=str, default=None, help='path to pre-trained model')
     parser.add_argument('--fig_name', type=str, default='test.png')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision scoring')
+    parser.add_argument('--refresh_estimator', action='store_true', help='recompute the cached maha estimator')
     parser.add_argument('--gpu_idx', type=int, default=0)
 
     args = parser.parse_args()
@@ -2,33 +2,38 @@
 Evaluate the CLF inference speed on TinyImages
 '''
 
+import os
 import time
 import argparse
 from pathlib import Path
 
 import torch
-from torch import nn
 from torchvision import transforms
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 
 from models import get_clf
 from datasets import get_ds_info, get_ds
+from utils import unwrap_state_dict
 
 def get_msp_score(data_loader, clf):
     clf.eval()
 
-    msp_score = []
+    # preallocated on GPU, copied back once
+    msp_score = torch.empty(len(data_loader.sampler), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
 
             prob = torch.softmax(logit, dim=1)
-            msp_score.extend(torch.max(prob, dim=1)[0].tolist())
+            msp_score[idx:idx+num] = torch.max(prob, dim=1)[0]
+        idx += num
 
-    return msp_score
+    return msp_score.cpu().numpy()
 
 def main(args):
     
@@ -41,13 +46,12 @@ def main(args):
     # load CLF
     num_classes = len(get_ds_info(args.id, 'classes'))
     clf = get_clf(args.arch, num_classes)
-    clf = nn.DataParallel(clf)
 
     clf_path = Path(args.pretrain)
     if clf_path.is_file():
         clf_state = torch.load(str(clf_path))
         cla_acc = clf_state['cla_acc']
-        clf.load_state_dict(clf_state['state_dict'])
+        clf.load_state_dict(unwrap_state_dict(clf_state['state_dict']))
         print('>>> load classifier from {} (classifiication acc {:.4f}%)'.format(str(clf_path), cla_acc))
     else:
         raise RuntimeError('<--- invlaid classifier path: {}'.format(str(clf_path)))
@@ -56,9 +60,9 @@ def main(args):
     gpu_idx = int(args.gpu_idx)
     if torch.cuda.is_available():
         torch.cuda.set_device(gpu_idx)
-        clf = nn.DataParallel(clf)
-        clf.cuda()
-        torch.cuda.manual_seed_all(args.seed)
+        # single device, a DataParallel 'module.' prefix is stripped from older checkpoints on load
+        clf.cuda().to(memory_format=torch.channels_last)
+        torch.cuda.manual_seed(args.seed)
     cudnn.benchmark = True
 
     begin_time = time.time()
@@ -72,7 +76,7 @@ if __name__ == '__main__':
     parser.add_argument('--id', type=str, default='cifar10')
     parser.add_argument('--ood', type=str, default='tiny_images')
     parser.add_argument('--batch_size', type=int, default=128)
-    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--prefetch', type=int, default=min(8, (os.cpu_count() or 2) // 2))
     parser.add_argument('--arch', type=str, default='wrn40')
     parser.add_argument('--pretrain', type=str, default=None, help='path to pre-trained model')
     parser.add_argument('--gpu_idx', type=int, default=0)
@@ -1,3 +1,5 @@
+import torch
+
 from .wide_resnet import Wide_ResNet, weights_init
 from .wide_resnet_pretrain import WideResNet
 from .densenet import DenseNet3
@@ -13,4 +15,60 @@ def get_clf(name, num_classes=10):
     else:
         raise RuntimeError('---> Invalid CLF name {}'.format(name))
     
-    return clf
\ No newline at end of file
+    return clf
+
+def compile_clf(clf, mode='reduce-overhead'):
+    # torch.compile is only available since PyTorch 2.0, fall back to eager otherwise
+    try:
+        return torch.compile(clf, mode=mode, fullgraph=False)
+    except (AttributeError, RuntimeError):
+        print('<<< torch.compile unavailable, running CLF eagerly')
+        return clf
+
+def graph_clf(clf, batch_size, img_size=32):
+    # capture forward & backward of the CLF into CUDA graphs for a fixed training batch shape,
+    # the graphs are only replayed in train mode, eval mode runs the eager forward
+    clf.train()
+    sample = torch.randn(batch_size, 3, img_size, img_size, device='cuda').to(memory_format=torch.channels_last)
+    return torch.cuda.make_graphed_callables(clf, (sample,))
+
+class _GraphedEvalCLF(torch.nn.Module):
+    # replays a CUDA graph of the eval forward for full batches, other shapes run the eager forward;
+    # the optimizer updates parameters in place, so a single capture stays valid across epochs
+    def __init__(self, clf, batch_size, ret_feat=False, amp_dtype=None, img_size=32):
+        super().__init__()
+        self.clf = clf
+        self.ret_feat = ret_feat
+        self.amp_dtype = amp_dtype
+        self.static_input = torch.zeros(batch_size, 3, img_size, img_size, device='cuda').to(memory_format=torch.channels_last)
+
+        # warm up on a side stream before capturing, cuDNN autotuning must not happen inside the graph
+        clf.eval()
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._forward(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output = self._forward(self.static_input)
+
+    def _forward(self, data, ret_feat=None):
+        ret_feat = self.ret_feat if ret_feat is None else ret_feat
+        with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            return self.clf(data, ret_feat)
+
+    def forward(self, data, ret_feat=False):
+        if self.training or ret_feat != self.ret_feat or data.shape != self.static_input.shape:
+            return self._forward(data, ret_feat)
+        
+        self.static_input.copy_(data, non_blocking=True)
+        self.graph.replay()
+        return self.static_output
+
+def graph_eval_clf(clf, batch_size, ret_feat=False, amp_dtype=None, img_size=32):
+    # capture the inference forward of the CLF for a fixed scoring batch shape,
+    # the outputs live in static buffers and are overwritten by the next replay
+    return _GraphedEvalCLF(clf, batch_size, ret_feat, amp_dtype, img_size)
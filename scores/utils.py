@@ -1,79 +1,73 @@
 import torch
 import torch.nn.functional as F
 
-# OOD samples have smaller score
-def get_kl_score(data_loader, clf):
-    clf.eval()
-    
-    kl_score = []
-    
-    for sample in data_loader:
-        data = sample['data'].cuda()
-        
-        with torch.no_grad():
-            
-            logit = clf(data)
-            
-        softmax = torch.softmax(logit, dim=1)
-        uniform_dist = torch.ones_like(softmax) * (1 / softmax.shape[1])
-        kl_score.extend(torch.sum(F.kl_div(softmax.log(), uniform_dist, reduction='none'), dim=1).tolist())
-    
-    return kl_score
-
-# OOD samples have larger weight
-def get_msp_weight(data_loader, clf, ret_feat):
+def get_logits(data_loader, clf, ret_feat=False, amp_dtype=None):
+    # one forward pass over the loader, shared by all weightings
     clf.eval()
 
-    msp_weight = []
-    feats = []
+    num_sample = len(data_loader.sampler)
+    logits, feats = None, None
 
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
 
-        with torch.no_grad():
+        # ranking candidates tolerates low precision, so scoring follows the training autocast dtype
+        with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
             
             if ret_feat:
                 logit, out = clf(data, ret_feat)
             else:
                 logit = clf(data, ret_feat)
 
-        prob = torch.softmax(logit, dim=1)
-        msp_weight.extend(torch.max(prob, dim=1)[0].tolist())
+        if logits is None:
+            logits = torch.empty(num_sample, logit.size(1), device='cuda')
+        logits[idx:idx+num] = logit
 
-        if len(feats) == 0:
-            feats = out
-        else:
-            feats = torch.cat([feats, out], dim=0)
-    
-    if ret_feat:
-        return [1.0 - msp for msp in msp_weight], feats
-    else:
-        return [1.0 - msp for msp in msp_weight]
+        if ret_feat:
+            if feats is None:
+                feats = torch.empty(num_sample, out.size(1), device='cuda')
+            feats[idx:idx+num] = out
+        idx += num
 
-# OOD samples have larger weight
-def get_abs_weight(data_loader, clf, ret_feat):
-    clf.eval()
+    return logits, feats
 
-    abs_weight = []
-    feats = []
+def neg_logsumexp(logits):
+    return -torch.logsumexp(logits, dim=1)
 
-    for sample in data_loader:
-        data = sample['data'].cuda()
+# inductor emits one Triton reduction per row (max, exp, sum, log in registers) instead of separate passes
+if hasattr(torch, 'compile'):
+    neg_logsumexp = torch.compile(neg_logsumexp, dynamic=True)
 
-        with torch.no_grad():
-            
-            if ret_feat:
-                logit, out = clf(data, ret_feat)
-            else:
-                logit = clf(data, ret_feat)
+# OOD samples have smaller score
+def get_kl_score(data_loader, clf):
+    logits, _ = get_logits(data_loader, clf)
+
+    # KL(uniform || softmax), on device with one host copy at the end
+    log_softmax = torch.log_softmax(logits, dim=1)
+    uniform_dist = torch.full_like(log_softmax, 1 / log_softmax.shape[1])
+    kl_score = torch.sum(F.kl_div(log_softmax, uniform_dist, reduction='none'), dim=1)
+
+    return kl_score.tolist()
+
+# OOD samples have larger weight
+def get_msp_weight(data_loader, clf, ret_feat, amp_dtype=None):
+    logits, feats = get_logits(data_loader, clf, ret_feat, amp_dtype)
 
-        prob = torch.softmax(logit, dim=1)
-        abs_weight.extend(prob[:, -1].tolist())
+    # max softmax prob = exp(max logit - logsumexp), without materializing the softmax
+    msp_weight = 1.0 - torch.exp(logits.amax(dim=1) - torch.logsumexp(logits, dim=1))
+    
+    if ret_feat:
+        return msp_weight, feats
+    else:
+        return msp_weight
+
+# OOD samples have larger weight
+def get_abs_weight(data_loader, clf, ret_feat, amp_dtype=None):
+    logits, feats = get_logits(data_loader, clf, ret_feat, amp_dtype)
 
-        if len(feats) == 0:
-            feats = out
-        else:
-            feats = torch.cat([feats, out], dim=0)
+    abs_weight = torch.exp(logits[:, -1] - torch.logsumexp(logits, dim=1))
     
     if ret_feat:
         return abs_weight, feats
@@ -81,27 +75,10 @@ def get_abs_weight(data_loader, clf, ret_feat):
         return abs_weight
 
 # OOD samples have larger weight
-def get_energy_weight(data_loader, clf, ret_feat):
-    clf.eval()
-    
-    energy_weight = []
-    feats = []
-    for sample in data_loader:
-        data = sample['data'].cuda()
-        
-        with torch.no_grad():
-            
-            if ret_feat:
-                logit, out = clf(data, ret_feat)
-            else:
-                logit = clf(data, ret_feat)
-        
-        energy_weight.extend((-torch.logsumexp(logit, dim=1)).tolist())
-    
-        if len(feats) == 0:
-            feats = out
-        else:
-            feats = torch.cat([feats, out], dim=0)
+def get_energy_weight(data_loader, clf, ret_feat, amp_dtype=None):
+    logits, feats = get_logits(data_loader, clf, ret_feat, amp_dtype)
+
+    energy_weight = neg_logsumexp(logits)
 
     if ret_feat:
         return energy_weight, feats
@@ -114,8 +91,8 @@ weight_dic = {
     'energy': get_energy_weight
 }
 
-def get_weight(data_loader, clf, weight_type, ret_feat=False):
+def get_weight(data_loader, clf, weight_type, ret_feat=False, amp_dtype=None):
     if weight_type in weight_dic.keys():
-        return weight_dic[weight_type](data_loader, clf, ret_feat)
+        return weight_dic[weight_type](data_loader, clf, ret_feat, amp_dtype)
     else:
         raise RuntimeError('<<< Invalid weight type {}'.format(weight_type))
\ No newline at end of file
@@ -0,0 +1,65 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils.checkpoint import to_cpu, save_async, wait_saves, unwrap_state_dict
+
+
+def test_to_cpu_keeps_containers_and_casts_floats_only():
+    state = {
+        'state_dict': {'weight': torch.ones(2, 2, requires_grad=True), 'num_batches_tracked': torch.tensor(3)},
+        'milestones': [torch.zeros(1), (torch.zeros(1), 'x')],
+        'epoch': 7
+    }
+
+    state_cpu = to_cpu(state, torch.float16)
+
+    assert state_cpu['state_dict']['weight'].dtype == torch.float16
+    assert not state_cpu['state_dict']['weight'].requires_grad
+    assert state_cpu['state_dict']['num_batches_tracked'].dtype == torch.int64
+    assert isinstance(state_cpu['milestones'], list) and isinstance(state_cpu['milestones'][1], tuple)
+    assert state_cpu['milestones'][1][1] == 'x'
+    assert state_cpu['epoch'] == 7
+    # the input state is left untouched
+    assert state['state_dict']['weight'].dtype == torch.float32
+
+
+def test_save_async_writes_snapshot(tmp_path):
+    weight = torch.ones(3)
+    path = tmp_path / '1.pth'
+
+    save_async({'state_dict': {'weight': weight}, 'cla_acc': 50.0}, str(path), half=True)
+    # later in-place updates must not leak into the snapshot
+    weight.add_(1)
+    wait_saves()
+
+    state = torch.load(str(path))
+    assert state['cla_acc'] == 50.0
+    assert state['state_dict']['weight'].dtype == torch.float16
+    assert torch.equal(state['state_dict']['weight'], torch.ones(3, dtype=torch.float16))
+
+
+def test_wait_saves_reraises_failed_write(tmp_path):
+    save_async({'epoch': 1}, str(tmp_path / 'missing' / '1.pth'))
+
+    with pytest.raises((OSError, RuntimeError)):
+        wait_saves()
+    # the failure is reported once
+    wait_saves()
+
+
+def test_save_async_reraises_previous_failed_write(tmp_path):
+    save_async({'epoch': 1}, str(tmp_path / 'missing' / '1.pth'))
+
+    with pytest.raises((OSError, RuntimeError)):
+        save_async({'epoch': 2}, str(tmp_path / '2.pth'))
+    wait_saves()
+
+
+def test_unwrap_state_dict():
+    weight = torch.zeros(1)
+
+    assert list(unwrap_state_dict({'module.linear.weight': weight})) == ['linear.weight']
+    assert list(unwrap_state_dict({'linear.weight': weight})) == ['linear.weight']
+    # only stripped if every key is prefixed
+    assert list(unwrap_state_dict({'module.a': weight, 'b': weight})) == ['module.a', 'b']
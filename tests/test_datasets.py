@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from datasets import TransformView
+
+
+def test_transform_view_applies_its_own_transform():
+    base = [{'data': 1, 'label': 0}, {'data': 2, 'label': 1}]
+
+    view_plus, view_times = TransformView(base, lambda x: x + 10), TransformView(base, lambda x: x * 10)
+
+    assert len(view_plus) == 2
+    assert view_plus[1] == {'data': 12, 'label': 1}
+    assert view_times[1] == {'data': 20, 'label': 1}
+    assert TransformView(base)[0] == {'data': 1, 'label': 0}
@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from detect import stable_cholesky
+
+
+def test_stable_cholesky_singular_covariance():
+    # rank 2 covariance in 4 dims, plus a dead (all-zero) feature dimension
+    X = torch.randn(100, 2, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+    X = torch.cat([X, X.sum(dim=1, keepdim=True), torch.zeros(100, 1, dtype=torch.float64)], dim=1)
+    cov = X.t().mm(X) / X.size(0)
+    assert torch.linalg.cholesky_ex(cov)[1].item() != 0
+
+    L = stable_cholesky(cov)
+
+    assert torch.isfinite(L).all()
+    assert torch.allclose(L.mm(L.t()), cov, atol=1e-3)
+
+
+def test_stable_cholesky_zero_covariance():
+    L = stable_cholesky(torch.zeros(3, 3, dtype=torch.float64))
+
+    assert torch.isfinite(L).all()
+    assert (L.diagonal() > 0).all()
+
+
+def test_stable_cholesky_positive_definite_unchanged():
+    cov = torch.tensor([[2.0, 0.5], [0.5, 1.0]], dtype=torch.float64)
+
+    assert torch.allclose(stable_cholesky(cov), torch.linalg.cholesky(cov))
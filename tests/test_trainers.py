@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn as nn
+
+from trainers import split_params
+
+
+class CLF(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, 3)
+        self.linear = nn.Linear(4, 10)
+
+
+class Wrapper(nn.Module):
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+
+@pytest.mark.parametrize('wrap', [False, True])
+def test_split_params(wrap):
+    clf = CLF()
+
+    parameters, linear_parameters = split_params(Wrapper(clf) if wrap else clf)
+
+    assert [id(p) for p in linear_parameters] == [id(clf.linear.weight), id(clf.linear.bias)]
+    assert [id(p) for p in parameters] == [id(clf.conv.weight), id(clf.conv.bias)]
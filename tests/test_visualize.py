@@ -0,0 +1,23 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+from visualize import histogram_probs
+
+
+@pytest.mark.parametrize('weights', [
+    np.random.default_rng(0).normal(size=1000).astype(np.float32),
+    np.random.default_rng(1).uniform(size=777),
+    # values sitting exactly on the bin edges
+    (np.round(np.random.default_rng(2).uniform(size=500) * 100) / 100).astype(np.float32),
+    np.full(10, 0.3, dtype=np.float32)
+])
+def test_histogram_probs_matches_np_histogram(weights):
+    bin_probs, bins = histogram_probs(weights)
+    bin_counts_np, bins_np = np.histogram(weights, bins=100)
+
+    assert bins.dtype == bins_np.dtype
+    assert np.array_equal(bins, bins_np)
+    assert bin_probs.dtype == np.float32
+    assert np.array_equal(bin_probs, (bin_counts_np / len(weights)).astype(np.float32))
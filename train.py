@@ -2,7 +2,6 @@
 Training on ID data for classification
 """
 
-import copy
 import time
 import random
 import argparse
@@ -13,56 +12,54 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
 
-from models import get_clf
-from utils import setup_logger
-from datasets import get_ds_info, get_ds_trf, get_ds
+from models import get_clf, compile_clf
+from utils import setup_logger, init_dist, is_main_process
+from datasets import get_ds_info, get_ds_trf, get_ds, cache_gpu_batches, CUDAPrefetcher
+from trainers import get_amp, get_sgd, split_params, optimize
 
 def init_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
+    # also seeds every CUDA device
     torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
-
-# scheduler
-def cosine_annealing(step, total_steps, lr_max, lr_min):
-    return lr_min + (lr_max - lr_min) * 0.5 * (1 + np.cos(step / total_steps * np.pi))
 
 # Training function
-def train(data_loader, net, optimizer, linear_optimizer, scheduler=None, linear_scheduler=None):
+def train(data_loader, net, optimizer, scheduler=None, amp_dtype=None, scaler=None):
     net.train()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
-    for sample in data_loader:
-        data = sample['data'].cuda()
-        target = sample['label'].cuda()
+    optimizer.zero_grad(set_to_none=True)
+    # batches are copied to the GPU on a side stream one step ahead
+    for sample in CUDAPrefetcher(data_loader):
+        data, target = sample['data'], sample['label']
 
         # forward
-        logit = net(data)
-        loss = F.cross_entropy(logit, target)
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+            logit = net(data)
+            loss = F.cross_entropy(logit, target)
 
         # backward
-        optimizer.zero_grad()
-        linear_optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        linear_optimizer.step()
+        optimize(loss, optimizer, scaler)
 
         if scheduler is not None:
             scheduler.step()
-
-        if linear_scheduler is not None:
-            linear_scheduler.step()
         
         # evaluate
         _, pred = logit.max(dim=1)
-        with torch.no_grad():
-            total_loss += loss.item()
-            correct += pred.eq(target).sum().item()
-            total += target.size(0)
+        total_loss += loss.detach()
+        correct += pred.eq(target).sum()
+        total += target.size(0)
+
+    total_loss, correct = total_loss.item(), correct.item()
 
     # average on sample
     print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader), 100. * correct / total))
@@ -72,34 +69,44 @@ def train(data_loader, net, optimizer, linear_optimizer, scheduler=None, linear_
     }
 
 # Test function
-def test(data_loader, net):
+def test(data_loader, net, amp_dtype=None):
     net.eval()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
-    with torch.no_grad():
+    with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
         for sample in data_loader:
-            data = sample['data'].cuda()
-            target = sample['label'].cuda()
+            data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            target = sample['label'].cuda(non_blocking=True)
 
             logit = net(data)
-            total_loss += F.cross_entropy(logit, target).item()
+            total_loss += F.cross_entropy(logit, target, reduction='sum')
 
             _, pred = logit.max(dim=1)
-            correct += pred.eq(target).sum().item()
+            correct += pred.eq(target).sum()
             total += target.size(0)
     
+    total_loss, correct = total_loss.item(), correct.item()
+
     # average on sample
-    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader), 100. * correct / total))
+    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / total, 100. * correct / total))
     return {
-        'cla_loss': total_loss / len(data_loader),
+        'cla_loss': total_loss / total,
         'cla_acc': 100. * correct / total
     }
 
 def main(args):
     # initialize random seed
     init_seeds(args.seed)
+    # TF32 for the fp32 matmuls / convs left outside autocast
+    torch.set_float32_matmul_precision('high')
+    cudnn.allow_tf32 = True
+
+    # one process per GPU (launch with torchrun for multi-GPU)
+    local_rank = init_dist(args.gpu_idx)
 
     # specify output dir
     # exp_path = Path(args.output_dir) / args.dataset / '-'.join([args.arch, args.clf_type, 'ce', args.scheduler])
@@ -108,7 +115,8 @@ def main(args):
     exp_path.mkdir(parents=True, exist_ok=True)
     
     # record log
-    setup_logger(str(exp_path), 'console.log')
+    if is_main_process():
+        setup_logger(str(exp_path), 'console.log')
 
     # init dataset & dataloader
     train_trf = get_ds_trf(args.dataset, stage='train')
@@ -117,8 +125,10 @@ def main(args):
     train_set = get_ds(root=args.data_dir, ds_name=args.dataset, split='train', transform=train_trf)
     test_set = get_ds(root=args.data_dir, ds_name=args.dataset, split='test', transform=test_trf)
 
-    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True)
-    test_loader = DataLoader(test_set, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+    train_sampler = DistributedSampler(train_set, shuffle=True, seed=args.seed)
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, sampler=train_sampler, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
+    # the test set uses deterministic transforms, keep it on GPU instead of reloading it every epoch
+    test_loader = cache_gpu_batches(DataLoader(test_set, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True))
 
     print('>>> Dataset {}'.format(args.dataset))
 
@@ -126,51 +136,31 @@ def main(args):
     num_classes = len(get_ds_info(args.dataset, 'classes'))
     print('>>> CLF {}'.format(args.arch))
     clf = get_clf(args.arch, num_classes)
-    clf = nn.DataParallel(clf)
 
     # move CLF to gpu device
-    gpu_idx = int(args.gpu_idx)
-    if torch.cuda.is_available():
-        torch.cuda.set_device(gpu_idx)
-        clf.cuda()
+    # gradients live directly in the all-reduce buckets, no per-step copy between the two
+    clf = DDP(clf.cuda().to(memory_format=torch.channels_last), device_ids=[local_rank], gradient_as_bucket_view=True)
     cudnn.benchmark = True
 
-    parameters, linear_parameters = [], []
-    for name, parameter in clf.named_parameters():
-        if name == 'module.linear.weight' or name == 'module.linear.bias':
-            linear_parameters.append(parameter)
-        else:
-            parameters.append(parameter)
+    # compiled CLF shares parameters with clf, which is kept for state_dict
+    clf_c = compile_clf(clf, args.compile_mode)
+
+    parameters, linear_parameters = split_params(clf)
     
     lr_stones = [int(args.epochs * float(lr_stone)) for lr_stone in args.lr_stones]
-    optimizer = torch.optim.SGD(parameters, lr=args.lr, weight_decay=args.weight_decay, momentum=args.momentum, nesterov=True)
-    linear_optimizer = torch.optim.SGD(linear_parameters, lr=args.lr, weight_decay=args.linear_weight_decay, momentum=args.momentum, nesterov=True)
+    # one optimizer, the linear head only differs by its weight decay param group
+    optimizer = get_sgd([
+        {'params': parameters, 'weight_decay': args.weight_decay},
+        {'params': linear_parameters, 'weight_decay': args.linear_weight_decay}
+    ], args.lr, args.momentum)
+    amp_dtype, scaler = get_amp(args.amp)
 
     if args.scheduler == 'multistep':
         print('LR: {:.2f} - WD: {:.5f} - LWD: {:.5f} - Mom: {:.2f} - Nes: True - LMS: {}'.format(args.lr, args.weight_decay, args.linear_weight_decay, args.momentum, args.lr_stones))
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=lr_stones, gamma=0.1)
-        linear_scheduler = torch.optim.lr_scheduler.MultiStepLR(linear_optimizer, milestones=lr_stones, gamma=0.1)
     elif args.scheduler == 'lambda':
         print('LR: {:.2f} - WD: {:.5f} - LWD: {:.5f} - Mom: {:.2f} - Nes: True'.format(args.lr, args.weight_decay, args.linear_weight_decay, args.momentum))
-        scheduler = torch.optim.lr_scheduler.LambdaLR(
-            optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader),
-                1,
-                1e-6 / args.lr
-            )
-        )
-
-        linear_scheduler = torch.optim.lr_scheduler.LambdaLR(
-            linear_optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader),
-                1,
-                1e-6 / args.lr
-            )
-        )
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs * len(train_loader), eta_min=1e-6)
     else:
         raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
 
@@ -179,26 +169,27 @@ def main(args):
     cla_acc, best_acc = 0.0, 0.0
 
     for epoch in range(start_epoch, args.epochs+1):
+        train_sampler.set_epoch(epoch)
 
         if args.scheduler == 'multistep':
-            train(train_loader, clf, optimizer, linear_optimizer)
+            train(train_loader, clf_c, optimizer, amp_dtype=amp_dtype, scaler=scaler)
             scheduler.step()
-            linear_scheduler.step()
         elif args.scheduler == 'lambda':
-            train(train_loader, clf, optimizer, linear_optimizer, scheduler, linear_scheduler)
+            train(train_loader, clf_c, optimizer, scheduler, amp_dtype=amp_dtype, scaler=scaler)
         else:
             raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
-        val_metrics = test(test_loader, clf)
+        val_metrics = test(test_loader, clf_c, amp_dtype)
         cla_acc = val_metrics['cla_acc']
         clf_best = cla_acc > best_acc
         
         if clf_best:
             best_acc = cla_acc
 
+            # the best state outlives this epoch, keep a host copy instead of a second model on GPU
             cla_best_state = {
                 'epoch': epoch,
                 'arch': args.arch,
-                'state_dict': copy.deepcopy(clf.state_dict()),
+                'state_dict': {k: v.detach().cpu() for k, v in clf.module.state_dict().items()},
                 'cla_acc': best_acc
             }
         
@@ -211,16 +202,19 @@ def main(args):
         )
     
     # ------------------------------------ Trainig done, save model ------------------------------------
-    torch.save({
-        'epoch': epoch,
-        'arch': args.arch,
-        'state_dict': copy.deepcopy(clf.state_dict()),
-        'cla_acc': cla_acc
-    }, str(exp_path / 'cla_last.pth'))
+    if is_main_process():
+        torch.save({
+            'epoch': epoch,
+            'arch': args.arch,
+            'state_dict': clf.module.state_dict(),
+            'cla_acc': cla_acc
+        }, str(exp_path / 'cla_last.pth'))
+
+        cla_best_path = exp_path / 'cla_best.pth'
+        torch.save(cla_best_state, str(cla_best_path))
+        print('---> Best classify acc: {:.4f}%'.format(best_acc))
 
-    cla_best_path = exp_path / 'cla_best.pth'
-    torch.save(cla_best_state, str(cla_best_path))
-    print('---> Best classify acc: {:.4f}%'.format(best_acc))
+    dist.destroy_process_group()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Train CLF')
@@ -238,7 +232,9 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--prefetch', type=int, default=16, help='number of dataloader workers')
-    parser.add_argument('--gpu_idx', help='used gpu idx', type=int, default=0)
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision training')
+    parser.add_argument('--compile_mode', type=str, default='reduce-overhead', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode of the CLF')
+    parser.add_argument('--gpu_idx', help='used gpu idx (ignored under torchrun)', type=int, default=0)
     args = parser.parse_args()
     
     main(args)
\ No newline at end of file
@@ -2,7 +2,7 @@
 Tuning or training with auxiliary OOD training data by classification undersampling
 '''
 
-import copy
+import os
 import time
 import random
 import argparse
@@ -18,56 +18,58 @@ import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from torch.utils.data import Subset, DataLoader
 
-from models import get_clf, weights_init
-from trainers import get_trainer
-from utils import setup_logger
-from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds
+from models import get_clf, weights_init, compile_clf
+from trainers import get_trainer, get_amp, get_sgd, split_params
+from utils import setup_logger, save_async, wait_saves
+from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds, TransformView
 from scores import get_weight
 
 def init_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
 
+    # also seeds every CUDA device
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
 
     cudnn.deterministic = True
     cudnn.benchmark = False
 
-# scheduler
-def cosine_annealing(step, total_steps, lr_max, lr_min):
-    return lr_min + (lr_max - lr_min) * 0.5 * (1 + np.cos(step / total_steps * np.pi))
-
-def test(data_loader, clf, num_classes):
+def test(data_loader, clf, num_classes, amp_dtype=None):
     clf.eval()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
     for sample in data_loader:
-        data = sample['data'].cuda()
-        target = sample['label'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = sample['label'].cuda(non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
             # forward
             logit = clf(data)
-        total_loss += F.cross_entropy(logit, target).item()
+        total_loss += F.cross_entropy(logit.float(), target, reduction='sum')
 
         _, pred = logit[:, :num_classes].max(dim=1)
-        correct += pred.eq(target).sum().item()
+        correct += pred.eq(target).sum()
         total += target.size(0)
 
+    total_loss, correct = total_loss.item(), correct.item()
+
     # average on sample
-    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader), 100. * correct / total))
+    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / total, 100. * correct / total))
     return {
-        'cla_loss': total_loss / len(data_loader),
+        'cla_loss': total_loss / total,
         'cla_acc': 100. * correct / total
     }
 
 def main(args):
 
     init_seeds(args.seed)
+    # TF32 for the fp32 matmuls / convs left outside autocast
+    torch.set_float32_matmul_precision('high')
+    cudnn.allow_tf32 = True
 
     exp_path = Path(args.output_dir) / ('s' + str(args.seed)) / (args.id + '-' + '_' + args.ood) / '-'.join([args.arch, 't', 'b_'+str(args.beta), args.scheduler, 'k_'+str(args.num_cluster), 'g_'+str(args.num_group)])
     exp_path.mkdir(parents=True, exist_ok=True)
@@ -86,14 +88,15 @@ def main(args):
     train_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='train', transform=train_trf_id)
     test_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='test', transform=test_trf_id)
     if args.ood == 'tiny_images':
-        train_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=test_trf_ood)
+        all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=None)
     elif args.ood in ['ti_300k', 'imagenet_64']:
-        train_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=test_trf_ood)
+        all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=None)
+    # training & candidate scoring read the same raw images, load them once and view with each transform
+    train_all_set_ood = TransformView(all_set_ood, train_trf_ood)
+    test_all_set_ood = TransformView(all_set_ood, test_trf_ood)
 
-    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True)
-    test_loader_id = DataLoader(test_set_id, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
+    test_loader_id = DataLoader(test_set_id, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0)
 
     # load pretrained model
     extractor = get_clf(args.extractor, 1000)
@@ -106,19 +109,26 @@ def main(args):
     gpu_idx = int(args.gpu_idx)
     if torch.cuda.is_available():
         torch.cuda.set_device(gpu_idx)
-        extractor.cuda()
+        extractor.cuda().to(memory_format=torch.channels_last)
     
     # feature clustering
     test_loader_all_ood = DataLoader(test_all_set_ood, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
     extractor.eval()
-    feats_ood = []
+    # features stay on device, one host copy after the pass
+    feats_ood = None
+    idx = 0
     for sample in test_loader_all_ood:
 
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
         
-        with torch.no_grad():
+        with torch.inference_mode():
             _, feat_ood = extractor(data, ret_feat=True)
-            feats_ood.extend(feat_ood.tolist())
+            if feats_ood is None:
+                feats_ood = torch.empty(len(test_all_set_ood), feat_ood.size(1), device='cuda')
+            feats_ood[idx:idx+num] = feat_ood
+        idx += num
+    feats_ood = feats_ood.cpu().numpy()
     
     # grouping by clustering
     k = args.num_cluster
@@ -127,25 +137,25 @@ def main(args):
 
     # get the training data idxs
     ## candidate cluster
-    size_clus = []
-    idxs_all_clus = []
-    for i in range(k):
-        idxs_clus = np.where(clus_ood == i)[0]
-        size_clus.append(len(idxs_clus))
-        idxs_all_clus.append(idxs_clus)
-        
-    idx_sorted_size_clus = np.argsort(np.array(size_clus))
-
-    idxs_sampled_ood = []
+    # group the idxs by cluster with one stable sort, instead of a np.where scan per cluster
+    order_clus = np.argsort(clus_ood, kind='stable')
+    starts_clus = np.searchsorted(clus_ood[order_clus], np.arange(k+1))
+    idxs_all_clus = [order_clus[starts_clus[i]:starts_clus[i+1]] for i in range(k)]
+    size_clus = np.diff(starts_clus)
+
+    idx_sorted_size_clus = np.argsort(size_clus)
+
+    rng = np.random.default_rng(args.seed)
+    size_avg_clus = int(len(train_set_id) / args.num_group)
+    # every group contributes size_avg_clus idxs, each writes its slice of one preallocated array
+    idxs_sampled_ood = np.empty(args.num_group * size_avg_clus, dtype=np.int64)
     for i in range(args.num_group):
-        size_avg_clus = int(len(train_set_id) / args.num_group)
-        if size_clus[idx_sorted_size_clus[i]] > size_avg_clus:
-            idxs_sampled_ood.extend(random.sample(idxs_all_clus[idx_sorted_size_clus[i]], k=size_avg_clus))
-        else:
-            idxs_sampled_ood.extend(random.choices(idxs_all_clus[idx_sorted_size_clus[i]], k=size_avg_clus))
+        idxs_clus = idxs_all_clus[idx_sorted_size_clus[i]]
+        # without replacement if the cluster is large enough, otherwise with replacement
+        idxs_sampled_ood[i*size_avg_clus:(i+1)*size_avg_clus] = rng.choice(idxs_clus, size_avg_clus, replace=len(idxs_clus) <= size_avg_clus)
 
     train_set_ood = Subset(train_all_set_ood, indices=idxs_sampled_ood)
-    train_loader_ood = DataLoader(train_set_ood, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+    train_loader_ood = DataLoader(train_set_ood, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
 
     print('>>> CLF: {}'.format(args.arch))
     if args.training in ['uni', 'energy']:
@@ -157,47 +167,31 @@ def main(args):
     gpu_idx = int(args.gpu_idx)
     if torch.cuda.is_available():
         torch.cuda.set_device(gpu_idx)
-        clf.cuda()
+        clf.cuda().to(memory_format=torch.channels_last)
     # clf.apply(weights_init)
 
+    # compiled CLF shares parameters with clf, which is kept for state_dict
+    clf_c = compile_clf(clf, args.compile_mode)
+
     # training parameters
-    parameters, linear_parameters = [], []
-    for name, parameter in clf.named_parameters():
-        if name in ['linear.weight', 'linear.bias']:
-            linear_parameters.append(parameter)
-        else:
-            parameters.append(parameter)
+    parameters, linear_parameters = split_params(clf)
 
     print('Optimizer: LR: {:.2f} - WD: {:.5f} - LWD: {:.5f} - Mom: {:.2f} - Nes: True'.format(args.lr, args.weight_decay, args.linear_weight_decay, args.momentum))
     trainer = get_trainer(args.training)
+    amp_dtype, scaler = get_amp(args.amp)
     lr_stones = [int(args.epochs * float(lr_stone)) for lr_stone in args.lr_stones]
-    optimizer = torch.optim.SGD(parameters, lr=args.lr, weight_decay=args.weight_decay, momentum=args.momentum, nesterov=True)
-    linear_optimizer = torch.optim.SGD(linear_parameters, lr=args.lr, weight_decay=args.linear_weight_decay, momentum=args.momentum, nesterov=True)
+    # one optimizer, the linear head only differs by its weight decay param group
+    optimizer = get_sgd([
+        {'params': parameters, 'weight_decay': args.weight_decay},
+        {'params': linear_parameters, 'weight_decay': args.linear_weight_decay}
+    ], args.lr, args.momentum)
     
     if args.scheduler == 'multistep':
         print('Scheduler: MultiStepLR - LMS: {}'.format(args.lr_stones))
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=lr_stones, gamma=0.1)
-        linear_scheduler = torch.optim.lr_scheduler.MultiStepLR(linear_optimizer, milestones=lr_stones, gamma=0.1)
     elif args.scheduler == 'lambda':
-        print('Scheduler: LambdaLR')
-        scheduler = torch.optim.lr_scheduler.LambdaLR(
-            optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
-        linear_scheduler = torch.optim.lr_scheduler.LambdaLR(
-            linear_optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
+        print('Scheduler: CosineAnnealingLR')
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs * len(train_loader_id), eta_min=1e-6)
     else:
         raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
     
@@ -208,15 +202,14 @@ def main(args):
     for epoch in range(start_epoch, args.epochs+1):
 
         if args.scheduler == 'multistep':
-            trainer(train_loader_id, train_loader_ood, clf, optimizer, linear_optimizer, beta=args.beta)
+            trainer(train_loader_id, train_loader_ood, clf_c, optimizer, beta=args.beta, amp_dtype=amp_dtype, scaler=scaler)
             scheduler.step()
-            linear_scheduler.step()
         elif args.scheduler == 'lambda':
-            trainer(train_loader_id, train_loader_ood, clf, optimizer, linear_optimizer, scheduler, linear_scheduler, beta=args.beta)
+            trainer(train_loader_id, train_loader_ood, clf_c, optimizer, scheduler, beta=args.beta, amp_dtype=amp_dtype, scaler=scaler)
         else:
             raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
                 
-        val_metrics = test(test_loader_id, clf, num_classes)
+        val_metrics = test(test_loader_id, clf_c, num_classes, amp_dtype)
         cla_acc = val_metrics['cla_acc']
 
         print(
@@ -228,27 +221,24 @@ def main(args):
         )
 
         if epoch % args.save_freq == 0:
-            torch.save({
+            save_async({
                 'epoch': epoch,
                 'arch': args.arch,
-                'state_dict': copy.deepcopy(clf.state_dict()),
-                'optimizer': copy.deepcopy(optimizer.state_dict()),
-                'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-                'scheduler': copy.deepcopy(scheduler.state_dict()),
-                'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
+                'state_dict': clf.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
                 'cla_acc': cla_acc
-            }, str(exp_path / (str(epoch)+'.pth')))
+            }, str(exp_path / (str(epoch)+'.pth')), half=args.half_ckpt)
     
     np.save(str(exp_path / 'diversity_scores.npy'), np.array(d_s))
 
+    wait_saves()
     torch.save({
         'epoch': epoch,
         'arch': args.arch,
-        'state_dict': copy.deepcopy(clf.state_dict()),
-        'optimizer': copy.deepcopy(optimizer.state_dict()),
-        'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-        'scheduler': copy.deepcopy(scheduler.state_dict()),
-        'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
+        'state_dict': clf.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
         'cla_acc': cla_acc
     }, str(exp_path / 'cla_last.pth'))
 
@@ -275,10 +265,13 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--print_freq', type=int, default=101)
     parser.add_argument('--save_freq', type=int, default=10)
+    parser.add_argument('--half_ckpt', action='store_true', help='store the weights of periodic checkpoints in fp16')
     parser.add_argument('--batch_size', type=int, default=2 ** 6) # 64
     parser.add_argument('--num_cluster', type=int, default=6)
     parser.add_argument('--num_group', type=int, default=1)
-    parser.add_argument('--prefetch', type=int, default=0, help='number of dataloader workers')
+    parser.add_argument('--prefetch', type=int, default=min(8, (os.cpu_count() or 2) // 2), help='number of dataloader workers')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision training')
+    parser.add_argument('--compile_mode', type=str, default='reduce-overhead', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode of the CLF')
     parser.add_argument('--gpu_idx', help='used gpu idx', type=int, default=0)
     args = parser.parse_args()
     
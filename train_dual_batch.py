@@ -2,77 +2,76 @@
 Tuning or training with auxiliary OOD training data by classification undersampling
 '''
 
-import copy
+import os
 import time
 import random
 import argparse
 import numpy as np
 from pathlib import Path
 
-from scipy.spatial.distance import euclidean
 from sklearn.cluster import KMeans
 from sklearn.metrics import calinski_harabasz_score
 
 import torch
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
-from torch.utils.data import Subset, DataLoader
+from torch.utils.data import DataLoader
 
-from models import get_clf, weights_init
-from trainers import get_trainer
-from utils import setup_logger
-from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds
+from models import get_clf, weights_init, compile_clf
+from trainers import get_trainer, get_amp, get_sgd, split_params, optimize
+from utils import setup_logger, save_async, wait_saves
+from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds, TransformView
 from scores import get_weight
 
 def init_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
 
+    # also seeds every CUDA device
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
 
     cudnn.deterministic = True
     cudnn.benchmark = False
 
-# scheduler
-def cosine_annealing(step, total_steps, lr_max, lr_min):
-    return lr_min + (lr_max - lr_min) * 0.5 * (1 + np.cos(step / total_steps * np.pi))
-
-def test(data_loader, clf, num_classes):
+def test(data_loader, clf, num_classes, amp_dtype=None):
     clf.eval()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
     for sample in data_loader:
-        data = sample['data'].cuda()
-        target = sample['label'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = sample['label'].cuda(non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
             # forward
             logit = clf(data)
-        total_loss += F.cross_entropy(logit, target).item()
+        total_loss += F.cross_entropy(logit.float(), target, reduction='sum')
 
         _, pred = logit[:, :num_classes].max(dim=1)
-        correct += pred.eq(target).sum().item()
+        correct += pred.eq(target).sum()
         total += target.size(0)
 
+    total_loss, correct = total_loss.item(), correct.item()
+
     # average on sample
-    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader), 100. * correct / total))
+    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / total, 100. * correct / total))
     return {
-        'cla_loss': total_loss / len(data_loader),
+        'cla_loss': total_loss / total,
         'cla_acc': 100. * correct / total
     }
 
 def main(args):
 
     init_seeds(args.seed)
+    # TF32 for the fp32 matmuls / convs left outside autocast
+    torch.set_float32_matmul_precision('high')
+    cudnn.allow_tf32 = True
 
-    epoch_seeds = [args.seed]
-    for i in range(args.epochs):
-        random.seed(epoch_seeds[i])
-        epoch_seeds.append(random.randint(1000 * i, 1000 * (i+1)))
+    # per-epoch seeds from a private generator, the global RNG state seeded above stays untouched
+    epoch_seeds = np.random.default_rng(args.seed).integers(0, 2 ** 31, size=args.epochs+1).tolist()
 
     exp_path = Path(args.output_dir) / ('s' + str(args.seed)) / (args.id + '-' + str(args.size_factor_sampled_ood) + '_' + args.ood) / '-'.join([args.arch, 't', 'b_'+str(args.beta), args.scheduler, 'r_'+str(args.ood_ratio), 'k_'+str(args.num_cluster)])
     exp_path.mkdir(parents=True, exist_ok=True)
@@ -88,14 +87,15 @@ def main(args):
     train_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='train', transform=train_trf_id)
     test_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='test', transform=test_trf_id)
     if args.ood == 'tiny_images':
-        train_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=test_trf_ood)
+        all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=None)
     elif args.ood in ['ti_300k', 'imagenet_64']:
-        train_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=test_trf_ood)
+        all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=None)
+    # training & candidate scoring read the same raw images, load them once and view with each transform
+    train_all_set_ood = TransformView(all_set_ood, train_trf_ood)
+    test_all_set_ood = TransformView(all_set_ood, test_trf_ood)
 
-    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True)
-    test_loader_id = DataLoader(test_set_id, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
+    test_loader_id = DataLoader(test_set_id, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0)
 
     print('>>> ID: {} - OOD: {}'.format(args.id, args.ood))
     num_classes = len(get_ds_info(args.id, 'classes'))
@@ -109,47 +109,31 @@ def main(args):
     gpu_idx = int(args.gpu_idx)
     if torch.cuda.is_available():
         torch.cuda.set_device(gpu_idx)
-        clf.cuda()
+        clf.cuda().to(memory_format=torch.channels_last)
     # clf.apply(weights_init)
 
+    # compiled CLF shares parameters with clf, which is kept for state_dict
+    clf_c = compile_clf(clf, args.compile_mode)
+
     # training parameters
-    parameters, linear_parameters = [], []
-    for name, parameter in clf.named_parameters():
-        if name in ['linear.weight', 'linear.bias']:
-            linear_parameters.append(parameter)
-        else:
-            parameters.append(parameter)
+    parameters, linear_parameters = split_params(clf)
 
     print('Optimizer: LR: {:.2f} - WD: {:.5f} - LWD: {:.5f} - Mom: {:.2f} - Nes: True'.format(args.lr, args.weight_decay, args.linear_weight_decay, args.momentum))
     trainer = get_trainer(args.training)
+    amp_dtype, scaler = get_amp(args.amp)
     lr_stones = [int(args.epochs * float(lr_stone)) for lr_stone in args.lr_stones]
-    optimizer = torch.optim.SGD(parameters, lr=args.lr, weight_decay=args.weight_decay, momentum=args.momentum, nesterov=True)
-    linear_optimizer = torch.optim.SGD(linear_parameters, lr=args.lr, weight_decay=args.linear_weight_decay, momentum=args.momentum, nesterov=True)
+    # one optimizer, the linear head only differs by its weight decay param group
+    optimizer = get_sgd([
+        {'params': parameters, 'weight_decay': args.weight_decay},
+        {'params': linear_parameters, 'weight_decay': args.linear_weight_decay}
+    ], args.lr, args.momentum)
     
     if args.scheduler == 'multistep':
         print('Scheduler: MultiStepLR - LMS: {}'.format(args.lr_stones))
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=lr_stones, gamma=0.1)
-        linear_scheduler = torch.optim.lr_scheduler.MultiStepLR(linear_optimizer, milestones=lr_stones, gamma=0.1)
     elif args.scheduler == 'lambda':
-        print('Scheduler: LambdaLR')
-        scheduler = torch.optim.lr_scheduler.LambdaLR(
-            optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
-        linear_scheduler = torch.optim.lr_scheduler.LambdaLR(
-            linear_optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
+        print('Scheduler: CosineAnnealingLR')
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs * len(train_loader_id), eta_min=1e-6)
     else:
         raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
     
@@ -157,30 +141,39 @@ def main(args):
     start_epoch = 1
     cla_acc = 0.0
 
+    # loop invariants, hoisted out of the per-batch sampling
+    num_all_ood = len(train_all_set_ood)
+    batch_size_ood = int(args.size_factor_sampled_ood * args.batch_size)
+    # one persistent candidate loader, the index list it samples from is refilled in place
+    sampler_candidate_ood = []
+    test_candidate_loader_ood = DataLoader(test_all_set_ood, batch_size=args.batch_size_candidate_ood, sampler=sampler_candidate_ood, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0)
+    # one persistent OOD training loader as well, refilled with the sampled indices for every ID batch
+    sampler_sampled_ood = []
+    train_loader_ood = DataLoader(train_all_set_ood, batch_size=batch_size_ood, sampler=sampler_sampled_ood, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None)
+
     # all_indices_sampled_ood = set()
     for epoch in range(start_epoch, args.epochs+1):
         epoch_time = time.time()
 
         init_seeds(epoch_seeds[epoch])
+        rng = np.random.default_rng(epoch_seeds[epoch])
 
-        batch_size_ood = int(args.size_factor_sampled_ood * args.batch_size)
         # train in batch
         for sample_id in train_loader_id:
 
             # randomly sample M candidate OOD points
-            indices_candidate_ood = np.array(random.sample(range(len(train_all_set_ood)), args.candidate_ood_size))
+            indices_candidate_ood = rng.choice(num_all_ood, args.candidate_ood_size, replace=False)
+            sampler_candidate_ood[:] = indices_candidate_ood.tolist()
 
             # get the ood score, then sort
-            test_candidate_set_ood = Subset(test_all_set_ood, indices_candidate_ood)
-            test_candidate_loader_ood = DataLoader(test_candidate_set_ood, batch_size=args.batch_size_candidate_ood, shuffle=False, num_workers=args.prefetch, pin_memory=True)
-
-            weights_candidate_ood, feats_candidate_ood = get_weight(test_candidate_loader_ood, clf, args.weighting, ret_feat=True)
-            weights_candidate_ood = np.array(weights_candidate_ood)
+            weights_candidate_ood, feats_candidate_ood = get_weight(test_candidate_loader_ood, clf_c, args.weighting, ret_feat=True, amp_dtype=amp_dtype)
             feats_candidate_ood = np.array(feats_candidate_ood.cpu())
-            idxs_sorted = np.argsort(weights_candidate_ood)
 
-            # keep the N proximal points with small OOD-ness
+            # keep the N proximal points with small OOD-ness: select them on device, copy back just the indices
             ept = int(args.candidate_ood_size * args.ood_ratio)
+            _, idxs_sorted = torch.topk(weights_candidate_ood, ept, largest=False, sorted=True)
+            idxs_sorted = idxs_sorted.cpu().numpy()
+            weights_candidate_ood = weights_candidate_ood.cpu().numpy()
             weights_proximial_ood = weights_candidate_ood[list(idxs_sorted[:ept])]
             feats_proximial_ood = feats_candidate_ood[list(idxs_sorted[:ept])]
 
@@ -189,33 +182,40 @@ def main(args):
             kmeans = KMeans(n_clusters=args.num_cluster, n_init=1).fit(feats_proximial_ood)
             clus_proximial_ood = kmeans.labels_
 
-            idxs_sampled = []
+            # preallocated, each cluster writes its slice
+            idxs_sampled = np.empty(batch_size_ood, dtype=np.int64)
+            num_sampled = 0
+
+            # group the idxs by cluster with one stable sort, instead of a np.where scan per cluster
+            order_clus = np.argsort(clus_proximial_ood, kind='stable')
+            starts_clus = np.searchsorted(clus_proximial_ood[order_clus], np.arange(k+1))
+            sampled_cluster_size = int(batch_size_ood / k)
 
             # --- kmeans - sub-cluster ---
             for i in range(k):
 
-                valid_idxs = np.where(clus_proximial_ood == i)[0]
-                sampled_cluster_size = int(batch_size_ood / k)
+                valid_idxs = order_clus[starts_clus[i]:starts_clus[i+1]]
 
                 if len(valid_idxs) <= sampled_cluster_size:
-                    idxs_sampled.extend(idxs_sorted[valid_idxs])
+                    idxs_sampled[num_sampled:num_sampled+len(valid_idxs)] = idxs_sorted[valid_idxs]
+                    num_sampled += len(valid_idxs)
                 else:
                     # greedy: sample OOD with small OOD-ness
                     # idxs_valid_sorted = np.argsort(weights_proximial_ood[valid_idxs])
                     
                     # typical: sample OOD with small distance to clustering center
                     k_c = kmeans.cluster_centers_[i]
-                    idxs_valid_sorted = np.argsort([euclidean(feats_proximial_ood[valid_idx], k_c) for valid_idx in valid_idxs])
+                    idxs_valid_sorted = np.argsort(np.linalg.norm(feats_proximial_ood[valid_idxs] - k_c, axis=1))
                     
-                    idxs_sampled.extend(idxs_sorted[valid_idxs[idxs_valid_sorted[:sampled_cluster_size]]])
+                    idxs_sampled[num_sampled:num_sampled+sampled_cluster_size] = idxs_sorted[valid_idxs[idxs_valid_sorted[:sampled_cluster_size]]]
+                    num_sampled += sampled_cluster_size
 
             # fill the empty: remove the already sampled, then randomly complete the sampled
-            idxs_sampled.extend(random.sample(list(set(idxs_sorted[:ept]) - set(idxs_sampled)), k=batch_size_ood - len(idxs_sampled)))
+            idxs_sampled[num_sampled:] = rng.choice(np.setdiff1d(idxs_sorted[:ept], idxs_sampled[:num_sampled], assume_unique=True), batch_size_ood - num_sampled, replace=False)
             indices_sampled_ood = indices_candidate_ood[idxs_sampled]
 
             # train
-            train_set_ood = Subset(train_all_set_ood, indices_sampled_ood)
-            train_loader_ood = DataLoader(train_set_ood, batch_size=batch_size_ood, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+            sampler_sampled_ood[:] = indices_sampled_ood.tolist()
 
             num_classes = len(train_loader_id.dataset.classes)
             clf.train()
@@ -226,45 +226,40 @@ def main(args):
                 num_id = sample_id['data'].size(0)
                 num_ood = sample_ood['data'].size(0)
 
-                data_id = sample_id['data'].cuda()
-                data_ood = sample_ood['data'].cuda()
+                data_id = sample_id['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                data_ood = sample_ood['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
                 data = torch.cat([data_id, data_ood], dim=0)
-                target_id = sample_id['label'].cuda()
-                target_ood = (torch.ones(num_ood) * num_classes).long().cuda()
+                target_id = sample_id['label'].cuda(non_blocking=True)
+                target_ood = torch.full((num_ood,), num_classes, dtype=torch.long, device='cuda')
 
                 # forward
-                logit = clf(data)
-                loss = F.cross_entropy(logit[:num_id], target_id)
-                loss += args.beta * F.cross_entropy(logit[num_id:], target_ood)
+                with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                    logit = clf_c(data)
+                    loss = F.cross_entropy(logit[:num_id], target_id)
+                    loss += args.beta * F.cross_entropy(logit[num_id:], target_ood)
 
-                # backward
-                optimizer.zero_grad()
-                linear_optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                linear_optimizer.step()
+                # backward (gradients are reset right after each step)
+                optimize(loss, optimizer, scaler)
 
             if args.scheduler == 'lambda':
                 scheduler.step()
-                linear_scheduler.step()
         
             # evaluate
-            _, pred = logit[:num_id, :num_classes].max(dim=1)
-            with torch.no_grad():
+            with torch.inference_mode():
+                _, pred = logit[:num_id, :num_classes].max(dim=1)
                 total_loss += loss.item()
                 correct += pred.eq(target_id).sum().item()
                 total += num_id
                     
         if args.scheduler == 'multistep':
             scheduler.step()
-            linear_scheduler.step()
         
         print('Epoch Time: ', time.time() - epoch_time)
 
         # average on sample
         print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(train_loader_id), 100. * correct / total))
         
-        val_metrics = test(test_loader_id, clf, num_classes)
+        val_metrics = test(test_loader_id, clf_c, num_classes, amp_dtype)
         cla_acc = val_metrics['cla_acc']
 
         # calculate proximity & diversity
@@ -289,28 +284,25 @@ def main(args):
         )
 
         if epoch % args.save_freq == 0:
-            torch.save({
+            save_async({
                 'epoch': epoch,
                 'arch': args.arch,
-                'state_dict': copy.deepcopy(clf.state_dict()),
-                'optimizer': copy.deepcopy(optimizer.state_dict()),
-                'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-                'scheduler': copy.deepcopy(scheduler.state_dict()),
-                'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
+                'state_dict': clf.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
                 'cla_acc': cla_acc
-            }, str(exp_path / (str(epoch)+'.pth')))
+            }, str(exp_path / (str(epoch)+'.pth')), half=args.half_ckpt)
     
     # Total sampled imgs number
     # print('Total:', len(all_indices_sampled_ood))
 
+    wait_saves()
     torch.save({
         'epoch': epoch,
         'arch': args.arch,
-        'state_dict': copy.deepcopy(clf.state_dict()),
-        'optimizer': copy.deepcopy(optimizer.state_dict()),
-        'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-        'scheduler': copy.deepcopy(scheduler.state_dict()),
-        'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
+        'state_dict': clf.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
         'cla_acc': cla_acc
     }, str(exp_path / 'cla_last.pth'))
 
@@ -335,13 +327,16 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--print_freq', type=int, default=101)
     parser.add_argument('--save_freq', type=int, default=10)
+    parser.add_argument('--half_ckpt', action='store_true', help='store the weights of periodic checkpoints in fp16')
     parser.add_argument('--batch_size', type=int, default=2 ** 6) # 64
     parser.add_argument('--batch_size_candidate_ood', type=int, default=384)
     parser.add_argument('--size_factor_sampled_ood', type=int, default=1)
     parser.add_argument('--candidate_ood_size', type=int, default=384) # 6:1
     parser.add_argument('--ood_ratio', type=float, default=0.5)
     parser.add_argument('--num_cluster', type=int, default=64) # 192: 24(8) -> 64: 8
-    parser.add_argument('--prefetch', type=int, default=0, help='number of dataloader workers')
+    parser.add_argument('--prefetch', type=int, default=min(8, (os.cpu_count() or 2) // 2), help='number of dataloader workers')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision training & OOD candidate scoring')
+    parser.add_argument('--compile_mode', type=str, default='reduce-overhead', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode of the CLF')
     parser.add_argument('--gpu_idx', help='used gpu idx', type=int, default=0)
     args = parser.parse_args()
     
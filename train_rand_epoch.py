@@ -2,7 +2,8 @@
 Tuning or training with auxiliary OOD training data by random resampling
 '''
 
-import copy
+import os
+import math
 import time
 import random
 import argparse
@@ -14,13 +15,16 @@ from sklearn.metrics import calinski_harabasz_score
 
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
-from torch.utils.data import Subset, DataLoader
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
 
-from models import get_clf, weights_init
-from trainers import get_trainer
-from utils import setup_logger
-from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds
+from models import get_clf, weights_init, compile_clf, graph_clf, graph_eval_clf
+from trainers import get_trainer, get_amp, get_sgd, split_params
+from utils import setup_logger, init_dist, is_main_process, save_async, wait_saves
+from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds, cache_gpu_batches
 from scores import get_weight
 
 
@@ -28,73 +32,76 @@ def init_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
 
+    # also seeds every CUDA device
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
 
     cudnn.deterministic = True
     cudnn.benchmark = False
 
-# scheduler
-def cosine_annealing(step, total_steps, lr_max, lr_min):
-    return lr_min + (lr_max - lr_min) * 0.5 * (1 + np.cos(step / total_steps * np.pi))
-
-def test(data_loader, clf, num_classes):
+def test(data_loader, clf, num_classes, amp_dtype=None):
     clf.eval()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
     for sample in data_loader:
-        data = sample['data'].cuda()
-        target = sample['label'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = sample['label'].cuda(non_blocking=True)
 
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
             # forward
             logit = clf(data)
-        total_loss += F.cross_entropy(logit, target).item()
+        total_loss += F.cross_entropy(logit.float(), target, reduction='sum')
 
         _, pred = logit[:, :num_classes].max(dim=1)
-        correct += pred.eq(target).sum().item()
+        correct += pred.eq(target).sum()
         total += target.size(0)
 
+    total_loss, correct = total_loss.item(), correct.item()
+
     # average on sample
-    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader), 100. * correct / total))
+    print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / total, 100. * correct / total))
     return {
-        'cla_loss': total_loss / len(data_loader),
+        'cla_loss': total_loss / total,
         'cla_acc': 100. * correct / total
     }
 
 def main(args):
 
     init_seeds(args.seed)
+    # TF32 for the fp32 matmuls / convs left outside autocast
+    torch.set_float32_matmul_precision('high')
+    cudnn.allow_tf32 = True
+
+    # one process per GPU (launch with torchrun for multi-GPU)
+    local_rank = init_dist(args.gpu_idx)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
     
-    epoch_seeds = [args.seed]
-    for i in range(args.epochs):
-        random.seed(epoch_seeds[i])
-        epoch_seeds.append(random.randint(1000 * i, 1000 * (i+1)))
+    # per-epoch seeds from a private generator, the global RNG state seeded above stays untouched
+    epoch_seeds = np.random.default_rng(args.seed).integers(0, 2 ** 31, size=args.epochs+1).tolist()
     
     exp_path = Path(args.output_dir) / ('s' + str(args.seed)) / (args.id + '-' + str(args.size_factor_sampled_ood) + '_' + args.ood) / '-'.join([args.arch, args.training, 'b_'+str(args.beta), args.scheduler, 'rand_epoch'])
     exp_path.mkdir(parents=True, exist_ok=True)
 
-    setup_logger(str(exp_path), 'console.log')
+    if is_main_process():
+        setup_logger(str(exp_path), 'console.log')
     print('>>> Output dir: {}'.format(str(exp_path)))
     
     train_trf_id = get_ds_trf(args.id, 'train')
     train_trf_ood = get_ood_trf(args.id, args.ood, 'train')
     test_trf_id = get_ds_trf(args.id, 'test')
-    test_trf_ood = get_ood_trf(args.id, args.ood, 'test')
 
     train_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='train', transform=train_trf_id)
     test_set_id = get_ds(root=args.data_dir, ds_name=args.id, split='test', transform=test_trf_id)
     if args.ood == 'tiny_images':
         train_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=test_trf_ood)
     elif args.ood in ['ti_300k', 'imagenet_64']:
         train_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=train_trf_ood)
-        test_all_set_ood = get_ds(root=args.data_dir, ds_name=args.ood, split='train', transform=test_trf_ood)
     
-    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True)
+    train_sampler_id = DistributedSampler(train_set_id, shuffle=True, seed=args.seed)
+    train_loader_id = DataLoader(train_set_id, batch_size=args.batch_size, sampler=train_sampler_id, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
     test_loader_id = DataLoader(test_set_id, batch_size=args.batch_size, shuffle=False, num_workers=args.prefetch, pin_memory=True)
 
     print('>>> ID: {} - OOD: {}'.format(args.id, args.ood))
@@ -105,51 +112,46 @@ def main(args):
     elif args.training == 'abs':
         clf = get_clf(args.arch, num_classes+1)
     
-    # move CLF to gpus
-    gpu_idx = int(args.gpu_idx)
-    if torch.cuda.is_available():
-        torch.cuda.set_device(gpu_idx)
-        clf.cuda()
+    # move CLF to gpu device, NHWC lets cuDNN pick tensor core kernels without layout transposes
+    # gradients live directly in the all-reduce buckets, no per-step copy between the two
+    clf = DDP(clf.cuda().to(memory_format=torch.channels_last), device_ids=[local_rank], gradient_as_bucket_view=True)
     # clf.apply(weights_init)
 
+    # the ID test set uses deterministic transforms, keep it on GPU instead of reloading it every epoch
+    test_loader_id = cache_gpu_batches(test_loader_id)
+
+    # compiled (or graphed) CLF shares parameters with clf, which is kept for state_dict
+    if args.cuda_graph:
+        if world_size > 1:
+            raise RuntimeError('<<< CUDA graph does not capture the DDP gradient all-reduce, run it on a single GPU')
+        if args.amp != 'none':
+            raise RuntimeError('<<< CUDA graph is captured in fp32, mixed precision {} not supported'.format(args.amp))
+        clf_c = graph_clf(clf.module, args.batch_size + int(args.size_factor_sampled_ood * args.batch_size))
+        # full ID test batches replay a captured eval forward, the last partial one runs eagerly
+        clf_t = graph_eval_clf(clf.module, args.batch_size)
+    else:
+        clf_c = compile_clf(clf, args.compile_mode)
+        clf_t = clf_c
+
     # training parameters
-    parameters, linear_parameters = [], []
-    for name, parameter in clf.named_parameters():
-        if name in ['linear.weight', 'linear.bias']:
-            linear_parameters.append(parameter)
-        else:
-            parameters.append(parameter)
+    parameters, linear_parameters = split_params(clf)
 
     print('Optimizer: LR: {:.2f} - WD: {:.5f} - LWD: {:.5f} - Mom: {:.2f} - Nes: True'.format(args.lr, args.weight_decay, args.linear_weight_decay, args.momentum))
     trainer = get_trainer(args.training)
+    amp_dtype, scaler = get_amp(args.amp)
     lr_stones = [int(args.epochs * float(lr_stone)) for lr_stone in args.lr_stones]
-    optimizer = torch.optim.SGD(parameters, lr=args.lr, weight_decay=args.weight_decay, momentum=args.momentum, nesterov=True)
-    linear_optimizer = torch.optim.SGD(linear_parameters, lr=args.lr, weight_decay=args.linear_weight_decay, momentum=args.momentum, nesterov=True)
+    # one optimizer, the linear head only differs by its weight decay param group
+    optimizer = get_sgd([
+        {'params': parameters, 'weight_decay': args.weight_decay},
+        {'params': linear_parameters, 'weight_decay': args.linear_weight_decay}
+    ], args.lr, args.momentum)
     
     if args.scheduler == 'multistep':
         print('Scheduler: MultiStepLR - LMS: {}'.format(args.lr_stones))
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=lr_stones, gamma=0.1)
-        linear_scheduler = torch.optim.lr_scheduler.MultiStepLR(linear_optimizer, milestones=lr_stones, gamma=0.1)
     elif args.scheduler == 'lambda':
-        print('Scheduler: LambdaLR')
-        scheduler = torch.optim.lr_scheduler.LambdaLR(
-            optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
-        linear_scheduler = torch.optim.lr_scheduler.LambdaLR(
-            linear_optimizer,
-            lr_lambda=lambda step: cosine_annealing(
-                step,
-                args.epochs * len(train_loader_id),
-                1,
-                1e-6 / args.lr
-            )
-        )
+        print('Scheduler: CosineAnnealingLR')
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs * math.ceil(len(train_loader_id) / args.accum_steps), eta_min=1e-6)
     else:
         raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
 
@@ -159,31 +161,32 @@ def main(args):
 
     epoch_size_sampled_ood = int(args.size_factor_sampled_ood * len(train_set_id))
     batch_size_sampled_ood = int(args.size_factor_sampled_ood * args.batch_size)
+    num_all_ood = len(train_all_set_ood)
+
+    # one persistent OOD training loader, the index list it samples from is refilled in place every epoch
+    sampler_sampled_ood = []
+    train_loader_ood = DataLoader(train_all_set_ood, batch_size=batch_size_sampled_ood, sampler=sampler_sampled_ood, num_workers=args.prefetch, pin_memory=True, persistent_workers=args.prefetch > 0, prefetch_factor=4 if args.prefetch > 0 else None, drop_last=True)
 
     for epoch in range(start_epoch, args.epochs+1):
         
         init_seeds(epoch_seeds[epoch])
+        train_sampler_id.set_epoch(epoch)
         
-        # candidate
-        indices_candidate_ood = np.array(random.sample(range(len(train_all_set_ood)), args.size_candidate_ood))
-        
-        # sampled
-        idxs_sampled = np.array(random.sample(range(len(indices_candidate_ood)), epoch_size_sampled_ood))
-        indices_sampled_ood = indices_candidate_ood[idxs_sampled]
+        # sampled: a uniform draw from a uniformly drawn candidate pool is a uniform draw from the whole set
+        # (every rank draws the same indices from the epoch seed, no broadcast needed)
+        indices_sampled_ood = np.random.default_rng(epoch_seeds[epoch]).choice(num_all_ood, epoch_size_sampled_ood, replace=False)
 
-        # training
-        train_set_ood = Subset(train_all_set_ood, indices_sampled_ood)
-        train_loader_ood = DataLoader(train_set_ood, batch_size=batch_size_sampled_ood, shuffle=False, num_workers=args.prefetch, pin_memory=True)
+        # training, each rank takes its own shard of the sampled OOD
+        sampler_sampled_ood[:] = indices_sampled_ood[rank::world_size].tolist()
         
         if args.scheduler == 'multistep':
-            trainer(train_loader_id, train_loader_ood, clf, optimizer, linear_optimizer, beta=args.beta)
+            trainer(train_loader_id, train_loader_ood, clf_c, optimizer, beta=args.beta, amp_dtype=amp_dtype, scaler=scaler, accum_steps=args.accum_steps)
             scheduler.step()
-            linear_scheduler.step()
         elif args.scheduler == 'lambda':
-            trainer(train_loader_id, train_loader_ood, clf, optimizer, linear_optimizer, scheduler, linear_scheduler, beta=args.beta)
+            trainer(train_loader_id, train_loader_ood, clf_c, optimizer, scheduler, beta=args.beta, amp_dtype=amp_dtype, scaler=scaler, accum_steps=args.accum_steps)
         else:
             raise RuntimeError('<<< Invalid scheduler: {}'.format(args.scheduler))
-        val_metrics = test(test_loader_id, clf, num_classes)
+        val_metrics = test(test_loader_id, clf_t, num_classes, amp_dtype)
         cla_acc = val_metrics['cla_acc']
 
         print(
@@ -194,31 +197,31 @@ def main(args):
             flush=True
         )
 
-        if epoch % args.save_freq == 0:
-            torch.save({
+        if epoch % args.save_freq == 0 and is_main_process():
+            save_async({
                 'epoch': epoch,
                 'arch': args.arch,
-                'state_dict': copy.deepcopy(clf.state_dict()),
-                'optimizer': copy.deepcopy(optimizer.state_dict()),
-                'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-                'scheduler': copy.deepcopy(scheduler.state_dict()),
-                'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
+                'state_dict': clf.module.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
                 'cla_acc': cla_acc
-            }, str(exp_path / (str(epoch)+'.pth')))
+            }, str(exp_path / (str(epoch)+'.pth')), half=args.half_ckpt)
 
     # Total sampled imgs number
     # print('Total:', len(all_indices_sampled_ood))
     
-    torch.save({
-        'epoch': epoch,
-        'arch': args.arch,
-        'state_dict': copy.deepcopy(clf.state_dict()),
-        'optimizer': copy.deepcopy(optimizer.state_dict()),
-        'linear_optimizer': copy.deepcopy(linear_optimizer.state_dict()),
-        'scheduler': copy.deepcopy(scheduler.state_dict()),
-        'linear_scheduler': copy.deepcopy(linear_scheduler.state_dict()),
-        'cla_acc': cla_acc
-    }, str(exp_path / 'cla_last.pth'))
+    if is_main_process():
+        wait_saves()
+        torch.save({
+            'epoch': epoch,
+            'arch': args.arch,
+            'state_dict': clf.module.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'cla_acc': cla_acc
+        }, str(exp_path / 'cla_last.pth'))
+
+    dist.destroy_process_group()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Outlier Exposure')
@@ -239,11 +242,15 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=100)
     parser.add_argument('--print_freq', type=int, default=101)
     parser.add_argument('--save_freq', type=int, default=10)
+    parser.add_argument('--half_ckpt', action='store_true', help='store the weights of periodic checkpoints in fp16')
     parser.add_argument('--batch_size', type=int, default=64)
-    parser.add_argument('--size_candidate_ood', type=int, default=300000)
+    parser.add_argument('--accum_steps', type=int, default=1, help='micro-batches per optimizer step, DDP all-reduces once per step')
     parser.add_argument('--batch_size_candidate_ood', type=int, default=3072)
     parser.add_argument('--size_factor_sampled_ood', type=int, default=1)
-    parser.add_argument('--prefetch', type=int, default=0, help='number of dataloader workers')
+    parser.add_argument('--prefetch', type=int, default=min(8, (os.cpu_count() or 2) // 2), help='number of dataloader workers')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision training')
+    parser.add_argument('--cuda_graph', action='store_true', help='replay the training step with CUDA graphs instead of torch.compile')
+    parser.add_argument('--compile_mode', type=str, default='reduce-overhead', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode of the CLF')
     parser.add_argument('--gpu_idx', help='used gpu idx', type=int, default=0)
     args = parser.parse_args()
     
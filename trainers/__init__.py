@@ -1 +1 @@
-from .utils import get_trainer
\ No newline at end of file
+from .utils import get_trainer, get_amp, get_sgd, split_params, grad_sync, optimize
\ No newline at end of file
@@ -1,44 +1,123 @@
+import contextlib
 import numpy as np
 from sklearn.cluster import KMeans
 
 import torch
 import torch.nn.functional as F
 
-def train_uni(data_loader_id, data_loader_ood, net, optimizer, linear_optimizer, scheduler=None, linear_scheduler=None, beta=0.5):
+from datasets import CUDAPrefetcher
+
+def oe_loss(logit_ood):
+    # cross entropy between the uniform distribution and the softmax of OOD logits
+    return (torch.logsumexp(logit_ood, dim=1) - logit_ood.mean(dim=1)).mean()
+
+def energy_loss(logit_id, logit_ood, m_in=-25.0, m_out=-7.0):
+    # squared hinges pushing the free energy of ID below m_in and of OOD above m_out
+    Ec_in = -torch.logsumexp(logit_id, dim=1)
+    Ec_out = -torch.logsumexp(logit_ood, dim=1)
+    return torch.pow(F.relu(Ec_in - m_in), 2).mean() + torch.pow(F.relu(m_out - Ec_out), 2).mean()
+
+# fuse the reductions into a single kernel (torch.compile requires PyTorch >= 2.0)
+if hasattr(torch, 'compile'):
+    oe_loss = torch.compile(oe_loss, mode='reduce-overhead')
+    energy_loss = torch.compile(energy_loss, mode='reduce-overhead')
+
+def grad_sync(net, step=True):
+    # DDP decides in the forward whether the backward all-reduces, so a non-stepping micro-batch
+    # has to run both its forward & backward under no_sync
+    if not step and hasattr(net, 'no_sync'):
+        return net.no_sync()
+    return contextlib.nullcontext()
+
+def optimize(loss, optimizer, scaler=None, step=True):
+    # step=False only accumulates this micro-batch's gradients
+    # fp16 needs loss scaling, fp32 & bf16 (scaler is None) step directly
+    if scaler is not None:
+        scaler.scale(loss).backward()
+    else:
+        loss.backward()
+
+    if step:
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+def get_amp(amp):
+    # fp16 needs a GradScaler against gradient underflow, bf16 keeps the fp32 exponent range
+    if amp == 'auto':
+        # bf16 where the GPU supports it (Ampere+), scaler-free
+        amp = 'bf16' if torch.cuda.is_bf16_supported() else 'fp16'
+    amp_dic = {
+        'none': None,
+        'fp16': torch.float16,
+        'bf16': torch.bfloat16
+    }
+    scaler = torch.cuda.amp.GradScaler() if amp == 'fp16' else None
+    return amp_dic[amp], scaler
+
+# parameters of the classification head, trained without the backbone weight decay
+HEAD_NAMES = {'linear.weight', 'linear.bias'}
+
+def split_params(clf):
+    # names are taken from the unwrapped CLF, so the split is the same with or without DDP
+    parameters, linear_parameters = [], []
+    for name, parameter in getattr(clf, 'module', clf).named_parameters():
+        if name in HEAD_NAMES:
+            linear_parameters.append(parameter)
+        else:
+            parameters.append(parameter)
+    return parameters, linear_parameters
+
+def get_sgd(param_groups, lr, momentum):
+    # the fused kernel (PyTorch 2.3+) updates all parameters in a few launches, fall back to the default otherwise
+    try:
+        return torch.optim.SGD(param_groups, lr=lr, momentum=momentum, nesterov=True, fused=True)
+    except (TypeError, RuntimeError):
+        return torch.optim.SGD(param_groups, lr=lr, momentum=momentum, nesterov=True)
+
+def train_uni(data_loader_id, data_loader_ood, net, optimizer, scheduler=None, beta=0.5, amp_dtype=None, scaler=None, accum_steps=1):
     net.train()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
-    for sample_id, sample_ood in zip(data_loader_id, data_loader_ood):
+    # the optimizer steps (and DDP all-reduces) once every accum_steps micro-batches, and on the last one
+    num_steps = min(len(data_loader_id), len(data_loader_ood))
+    optimizer.zero_grad(set_to_none=True)
+
+    # batches are copied to the GPU on a side stream one step ahead
+    for i, (sample_id, sample_ood) in enumerate(zip(CUDAPrefetcher(data_loader_id), CUDAPrefetcher(data_loader_ood))):
+        step = (i + 1) % accum_steps == 0 or i + 1 == num_steps
         num_id = sample_id['data'].size(0)
 
-        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0).cuda()
-        target = sample_id['label'].cuda()
+        # already on device & channels_last (the concatenation keeps the memory format)
+        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0)
+        target = sample_id['label']
 
-        # forward
-        logit = net(data)
-        loss = F.cross_entropy(logit[:num_id], target)
-        loss += beta * -(logit[num_id:].mean(dim=1) - torch.logsumexp(logit[num_id:], dim=1)).mean()
+        # forward & backward, under DDP the gradients are only all-reduced on the stepping micro-batch
+        with grad_sync(net, step):
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                logit = net(data)
+                loss = F.cross_entropy(logit[:num_id], target)
+                loss += beta * oe_loss(logit[num_id:])
 
-        # backward
-        optimizer.zero_grad()
-        linear_optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        linear_optimizer.step()
+            optimize(loss / accum_steps, optimizer, scaler, step)
 
-        if scheduler is not None:
+        if scheduler is not None and step:
             scheduler.step()
-        if linear_scheduler is not None:
-            linear_scheduler.step()
 
         # evaluate
         _, pred = logit[:num_id].max(dim=1)
-        with torch.no_grad():
-            total_loss += loss.item()
-            correct += pred.eq(target).sum().item()
-            total += num_id
+        total_loss += loss.detach()
+        correct += pred.eq(target).sum()
+        total += num_id
+
+    total_loss, correct = total_loss.item(), correct.item()
 
     # average on sample
     print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader_id), 100. * correct / total))
@@ -47,45 +126,50 @@ def train_uni(data_loader_id, data_loader_ood, net, optimizer, linear_optimizer,
         'cla_acc': 100. * correct / total
     }
 
-def train_abs(data_loader_id, data_loader_ood, net, optimizer, linear_optimizer, scheduler=None, linear_scheduler=None, beta=1.0):
+def train_abs(data_loader_id, data_loader_ood, net, optimizer, scheduler=None, beta=1.0, amp_dtype=None, scaler=None, accum_steps=1):
     num_classes = len(data_loader_id.dataset.classes)
     net.train()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
-    for sample_id, sample_ood in zip(data_loader_id, data_loader_ood):
+    # the optimizer steps (and DDP all-reduces) once every accum_steps micro-batches, and on the last one
+    num_steps = min(len(data_loader_id), len(data_loader_ood))
+    optimizer.zero_grad(set_to_none=True)
+
+    # batches are copied to the GPU on a side stream one step ahead
+    for i, (sample_id, sample_ood) in enumerate(zip(CUDAPrefetcher(data_loader_id), CUDAPrefetcher(data_loader_ood))):
+        step = (i + 1) % accum_steps == 0 or i + 1 == num_steps
         
         num_id = sample_id['data'].size(0)
         num_ood = sample_ood['data'].size(0)
 
-        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0).cuda()
-        target_id = sample_id['label'].cuda()
-        target_ood = (torch.ones(num_ood) * num_classes).long().cuda()
+        # already on device & channels_last (the concatenation keeps the memory format)
+        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0)
+        target_id = sample_id['label']
+        target_ood = torch.full((num_ood,), num_classes, dtype=torch.long, device='cuda')
 
-        # forward
-        logit = net(data)
-        loss = F.cross_entropy(logit[:num_id], target_id)
-        loss += beta * F.cross_entropy(logit[num_id:], target_ood)
+        # forward & backward, under DDP the gradients are only all-reduced on the stepping micro-batch
+        with grad_sync(net, step):
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                logit = net(data)
+                loss = F.cross_entropy(logit[:num_id], target_id)
+                loss += beta * F.cross_entropy(logit[num_id:], target_ood)
 
-        # backward
-        optimizer.zero_grad()
-        linear_optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        linear_optimizer.step()
+            optimize(loss / accum_steps, optimizer, scaler, step)
 
-        if scheduler is not None:
+        if scheduler is not None and step:
             scheduler.step()
-        if linear_scheduler is not None:
-            linear_scheduler.step()
 
         # evaluate
         _, pred = logit[:num_id, :num_classes].max(dim=1)
-        with torch.no_grad():
-            total_loss += loss.item()
-            correct += pred.eq(target_id).sum().item()
-            total += num_id
+        total_loss += loss.detach()
+        correct += pred.eq(target_id).sum()
+        total += num_id
+
+    total_loss, correct = total_loss.item(), correct.item()
 
     # average on sample
     print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader_id), 100. * correct / total))
@@ -95,42 +179,45 @@ def train_abs(data_loader_id, data_loader_ood, net, optimizer, linear_optimizer,
     }
 
 
-def train_energy(data_loader_id, data_loader_ood, net, optimizer, linear_optimizer, scheduler=None, linear_scheduler=None, beta=0.1):
+def train_energy(data_loader_id, data_loader_ood, net, optimizer, scheduler=None, beta=0.1, amp_dtype=None, scaler=None, accum_steps=1):
     net.train()
 
-    total, correct = 0, 0
-    total_loss = 0.0
+    # accumulate on device, synchronize once after the loop
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    total_loss = torch.zeros((), device='cuda')
 
-    for sample_id, sample_ood in zip(data_loader_id, data_loader_ood):
+    # the optimizer steps (and DDP all-reduces) once every accum_steps micro-batches, and on the last one
+    num_steps = min(len(data_loader_id), len(data_loader_ood))
+    optimizer.zero_grad(set_to_none=True)
+
+    # batches are copied to the GPU on a side stream one step ahead
+    for i, (sample_id, sample_ood) in enumerate(zip(CUDAPrefetcher(data_loader_id), CUDAPrefetcher(data_loader_ood))):
+        step = (i + 1) % accum_steps == 0 or i + 1 == num_steps
         num_id = sample_id['data'].size(0)
 
-        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0).cuda()
-        target = sample_id['label'].cuda()
+        # already on device & channels_last (the concatenation keeps the memory format)
+        data = torch.cat([sample_id['data'], sample_ood['data']], dim=0)
+        target = sample_id['label']
 
-        logit = net(data)
-        loss = F.cross_entropy(logit[:num_id], target)
-        Ec_in = -torch.logsumexp(logit[:num_id], dim=1)
-        Ec_out = -torch.logsumexp(logit[num_id:], dim=1)
-        m_in = -25
-        m_out = -7
-        loss += beta * (torch.pow(F.relu(Ec_in - m_in), 2).mean() + torch.pow(F.relu(m_out-Ec_out), 2).mean())
+        # under DDP the gradients are only all-reduced on the stepping micro-batch
+        with grad_sync(net, step):
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                logit = net(data)
+                loss = F.cross_entropy(logit[:num_id], target)
+                loss += beta * energy_loss(logit[:num_id], logit[num_id:])
 
-        optimizer.zero_grad()
-        linear_optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        linear_optimizer.step()
+            optimize(loss / accum_steps, optimizer, scaler, step)
 
-        if scheduler is not None:
+        if scheduler is not None and step:
             scheduler.step()
-        if linear_scheduler is not None:
-            linear_scheduler.step()
         
         _, pred = logit[:num_id].max(dim=1)
-        with torch.no_grad():
-            total_loss += loss.item()
-            correct += pred.eq(target).sum().item()
-            total += num_id
+        total_loss += loss.detach()
+        correct += pred.eq(target).sum()
+        total += num_id
+
+    total_loss, correct = total_loss.item(), correct.item()
 
     # average on sample
     print('[cla loss: {:.8f} | cla acc: {:.4f}%]'.format(total_loss / len(data_loader_id), 100. * correct / total))
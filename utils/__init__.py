@@ -1,2 +1,4 @@
 from .logger import setup_logger
-from .metrics import compute_all_metrics
\ No newline at end of file
+from .metrics import compute_all_metrics
+from .dist import init_dist, is_main_process
+from .checkpoint import save_async, wait_saves, unwrap_state_dict
@@ -0,0 +1,50 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+# a single writer keeps checkpoints on disk in submission order
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_last_save = None
+
+def to_cpu(obj, dtype=None):
+    # host copies of all tensors in a (nested) state dict, container types are kept for load_state_dict
+    # floating point tensors are cast to dtype (on device, before the copy) if given
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        if dtype is not None and obj.is_floating_point():
+            obj = obj.to(dtype)
+        return obj.cpu()
+    elif isinstance(obj, dict):
+        obj_cpu = copy.copy(obj)
+        for k, v in obj.items():
+            obj_cpu[k] = to_cpu(v, dtype)
+        return obj_cpu
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v, dtype) for v in obj)
+    else:
+        return obj
+
+def unwrap_state_dict(state_dict, prefix='module.'):
+    # checkpoints written from an nn.DataParallel / DDP wrapper prefix every key, strip it for the bare CLF
+    if all(k.startswith(prefix) for k in state_dict.keys()):
+        return type(state_dict)((k[len(prefix):], v) for k, v in state_dict.items())
+    return state_dict
+
+def save_async(state, path, half=False):
+    # snapshot to host now (training keeps updating the GPU tensors), serialize while the next epoch runs
+    # half: store the model weights ('state_dict') in fp16, load_state_dict casts them back on load
+    global _last_save
+    state_cpu = {k: to_cpu(v, torch.float16 if half and k == 'state_dict' else None) for k, v in state.items()}
+    # surface a failed previous write (disk full, bad path, pickling) instead of dropping it with its future
+    wait_saves()
+    _last_save = _save_executor.submit(torch.save, state_cpu, path)
+    return _last_save
+
+def wait_saves():
+    # block until the pending checkpoint is on disk, re-raises its exception if the write failed
+    global _last_save
+    if _last_save is not None:
+        last_save, _last_save = _last_save, None
+        last_save.result()
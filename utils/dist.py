@@ -0,0 +1,30 @@
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+
+
+def init_dist(gpu_idx):
+    # torchrun exports LOCAL_RANK for each process (one per GPU),
+    # plain `python` runs fall back to a single-process group on gpu_idx
+    if 'LOCAL_RANK' in os.environ:
+        local_rank = int(os.environ['LOCAL_RANK'])
+    else:
+        local_rank = int(gpu_idx)
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        # bind a free port, a fixed one collides when several runs share a host (one per --gpu_idx)
+        if 'MASTER_PORT' not in os.environ:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.bind(('', 0))
+                os.environ['MASTER_PORT'] = str(s.getsockname()[1])
+        os.environ.setdefault('RANK', '0')
+        os.environ.setdefault('WORLD_SIZE', '1')
+
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl')
+
+    return local_rank
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
@@ -2,84 +2,103 @@
 Detect OOD samples with CLF
 '''
 
+import math
 import argparse
 import numpy as np
 from pathlib import Path
-from scipy.stats import norm
+from scipy.special import ndtr
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 from sklearn.mixture import GaussianMixture as GMM
 
 import torch
-import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.utils.data import Subset, DataLoader
 
-from models import get_clf
-from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds
+from models import get_clf, compile_clf
+from datasets import get_ds_info, get_ds_trf, get_ood_trf, get_ds, cache_gpu_batches
+from trainers import get_amp
+from utils import unwrap_state_dict
+
+def num_samples(data_loader):
+    # a DataLoader, or the GPU resident batches from cache_gpu_batches
+    if isinstance(data_loader, DataLoader):
+        return len(data_loader.sampler)
+    return sum(sample['data'].size(0) for sample in data_loader)
 
 # OOD samples have larger weight
 def get_msp_weight(data_loader, clf):
     clf.eval()
 
-    msp_weight = []
+    # preallocated on GPU, copied back once
+    msp_weight = torch.empty(num_samples(data_loader), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
 
             prob = torch.softmax(logit, dim=1)
-            msp_weight.extend(torch.max(prob, dim=1)[0].tolist())
+            msp_weight[idx:idx+num] = 1.0 - torch.max(prob, dim=1)[0]
+        idx += num
 
-    return [1.0 - msp for msp in msp_weight]
+    return msp_weight.cpu()
 
 # OOD samples have larger weight
 def get_abs_weight(data_loader, clf):
     clf.eval()
 
-    abs_weight = []
+    abs_weight = torch.empty(num_samples(data_loader), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
 
             prob = torch.softmax(logit, dim=1)
-            abs_weight.extend(prob[:, -1].tolist())
+            abs_weight[idx:idx+num] = prob[:, -1]
+        idx += num
 
-    return abs_weight
+    return abs_weight.cpu()
 
 # OOD samples have larger weight
 def get_energy_weight(data_loader, clf):
     clf.eval()
     
-    energy_weight = []
-
+    energy_weight = torch.empty(num_samples(data_loader), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
         
-        with torch.no_grad():
+        with torch.inference_mode():
             logit = clf(data)
-            energy_weight.extend((-torch.logsumexp(logit, dim=1)).tolist())
+            energy_weight[idx:idx+num] = -torch.logsumexp(logit, dim=1)
+        idx += num
     
-    return energy_weight
+    return energy_weight.cpu()
 
 # OOD samples have larger weight
 def get_binary_weight(data_loader, clf):
     clf.eval()
 
-    binary_weight = []
+    binary_weight = torch.empty(num_samples(data_loader), device='cuda')
+    idx = 0
     for sample in data_loader:
-        data = sample['data'].cuda()
+        data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        num = data.size(0)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             _, _, energy_logit = clf(data, ret_feat=True, ret_el=True)
             # energy_prob = torch.max(torch.softmax(energy_logit, dim=1), dim=1)[0].tolist()
-            energy_prob = torch.sigmoid(energy_logit).tolist()
-            binary_weight.extend(energy_prob)
+            binary_weight[idx:idx+num] = torch.sigmoid(energy_logit).view(-1)
+        idx += num
     
-    return binary_weight
+    return binary_weight.cpu()
 
 weight_dic = {
     'msp': get_msp_weight,
@@ -92,10 +111,10 @@ def get_acc(data_loader, clf, num_classes):
     clf.eval()
     correct, total = 0, 0
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for sample in data_loader:
-            data = sample['data'].cuda()
-            target = sample['label'].cuda()
+            data = sample['data'].cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            target = sample['label'].cuda(non_blocking=True)
 
             logit = clf(data)
 
@@ -106,46 +125,75 @@ def get_acc(data_loader, clf, num_classes):
     print(correct / total * 100.)
     return correct / total * 100.
 
-def visualize_weight(data_loader_id, data_loader_ood, clf):
+def histogram_probs(weights, num_bins=100):
+    # equal-width bins: one scaled cast + bincount, counts & edges as np.histogram would return them
+    # range & edges stay in the weights' dtype (float32), computed the same way as np.histogram's
+    lo, hi = weights.min(), weights.max()
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    bins = np.linspace(lo, hi, num_bins + 1, dtype=np.result_type(lo, hi, weights))
+    idxs = np.clip(((weights - lo) / (hi - lo) * num_bins).astype(np.intp), 0, num_bins - 1)
+    # the scaled cast can be one bin off right at an edge, correct it against the edges like np.histogram
+    idxs[weights < bins[idxs]] -= 1
+    idxs[(weights >= bins[idxs + 1]) & (idxs != num_bins - 1)] += 1
+    bin_counts = np.bincount(idxs, minlength=num_bins)
+    # float32 like the weights, written in place without a float64 temporary
+    bin_probs = np.empty(num_bins, dtype=np.float32)
+    np.divide(bin_counts, len(weights), out=bin_probs, casting='unsafe')
+
+    return bin_probs, bins
+
+def visualize_weight(data_loader_id, data_loader_ood, clf, amp_dtype=None):
     
+    # only every plot_every-th checkpoint is scored & drawn, the subplot grid (and canvas) shrinks with it
+    clf_idxs = list(range(0, 100, args.plot_every))
+    num_cols = math.ceil(math.sqrt(len(clf_idxs)))
+    num_rows = math.ceil(len(clf_idxs) / num_cols)
+
     plt.clf()
-    plt.figure(figsize=(100, 100), dpi=100)
+    # a full 10x10 grid at 10 inch / 100 dpi per subplot is a 10000x10000 px RGBA canvas (~400MB), keep it small by default
+    fig = plt.figure(figsize=(args.subplot_size * num_cols, args.subplot_size * num_rows), dpi=args.dpi)
+
+    # move CLF to gpu device & seed once, every checkpoint is loaded into the same on-device parameters
+    if torch.cuda.is_available():
+        clf.cuda().to(memory_format=torch.channels_last)
+        torch.cuda.manual_seed(args.seed)
+    cudnn.benchmark = True
+
+    # compiled once, checkpoints are loaded into the shared parameters in place
+    clf_c = compile_clf(clf)
 
-    for i in range(100):
+    # successive checkpoints have close weight distributions, so each fit starts from the previous one
+    gmm = GMM(n_components=3, warm_start=True)
+    rng = np.random.default_rng(args.seed)
+
+    for j, i in enumerate(clf_idxs):
         clf_path = Path(args.output_dir) / (str(i+1) + '.pth')
         # clf_path = Path(args.output_dir) / (str(i) + '.pth')
 
         if clf_path.is_file():
             clf_state = torch.load(str(clf_path))
             cla_acc = clf_state['cla_acc']
-            clf.load_state_dict(clf_state['state_dict'])
+            clf.load_state_dict(unwrap_state_dict(clf_state['state_dict']))
             print('>>> load classifier from {} (classification acc {:.4f}%)'.format(str(clf_path), cla_acc))
         else:
             raise RuntimeError('<--- invlaid classifier path: {}'.format(str(clf_path)))
 
-        # move CLF to gpu device
-        gpu_idx = int(args.gpu_idx)
-        if torch.cuda.is_available():
-            torch.cuda.set_device(gpu_idx)
-            clf.cuda()
-            torch.cuda.manual_seed(args.seed)
-        cudnn.benchmark = True
-
         get_weight = weight_dic[args.weighting]
-        weight_id = get_weight(data_loader_id, clf)
-        weight_ood = get_weight(data_loader_ood, clf)
+        # weights only rank samples & feed a 100-bin histogram, low precision scoring is enough
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+            weight_id = get_weight(data_loader_id, clf_c)
+            weight_ood = get_weight(data_loader_ood, clf_c)
         
-        ax = plt.subplot(10, 10, i+1)
-        # plt.subplot(10, 10, i+1)
+        ax = plt.subplot(num_rows, num_cols, j+1)
         
-        weight_id = np.asarray(weight_id)
-        weight_ood = np.asarray(weight_ood)
+        weight_id = weight_id.numpy()
+        weight_ood = weight_ood.numpy()
 
         # true weights distribution
         # bin_counts_id, bins_id = np.histogram(weight_id, bins=100)
         # bin_probs_id = bin_counts_id / len(weight_id)
-        bin_counts, bins = np.histogram(weight_ood, bins=100)
-        bin_probs = bin_counts / len(weight_ood)
+        bin_probs, bins = histogram_probs(weight_ood)
 
         # get the sigmoid prob for bins
         points = np.array([bins[:-1], bin_probs]).T.reshape(-1, 1, 2)
@@ -154,7 +202,8 @@ def visualize_weight(data_loader_id, data_loader_ood, clf):
         c_norm = plt.Normalize(0, 1)
         lc = LineCollection(segments, cmap='viridis', norm=c_norm)
 
-        lc_colors = torch.sigmoid(clf.module.binary_linear.weight.detach().cpu() * np.array(bins[:-1])).squeeze()
+        binary_w = clf.binary_linear.weight.detach().cpu().squeeze()
+        lc_colors = torch.sigmoid(binary_w * torch.from_numpy(bins[:-1])).squeeze()
         lc.set_array(lc_colors)
         line = ax.add_collection(lc)
         plt.colorbar(line, ax=ax)
@@ -162,46 +211,43 @@ def visualize_weight(data_loader_id, data_loader_ood, clf):
         ax.set_xlim(min(bins), max(bins))
         ax.set_ylim(0.0, 0.20)
 
-        sep_line = True
-        for bin_ in bins[::-1][1:]:
-            if sep_line:
-                binary_ = torch.sigmoid(clf.module.binary_linear.weight.detach().cpu() * np.array(bin_)).squeeze().item()
-                if  binary_ < 0.99:
-                    plt.axvline(x=bin_, ls="-", c="green")
-                    sep_line = False
+        # separation line at the first bin (from the right) whose sigmoid prob drops below 0.99
+        bins_rev = np.ascontiguousarray(bins[::-1][1:])
+        binary_ = torch.sigmoid(binary_w * torch.from_numpy(bins_rev)).numpy()
+        idxs_sep = np.flatnonzero(binary_ < 0.99)
+        if len(idxs_sep) > 0:
+            plt.axvline(x=bins_rev[idxs_sep[0]], ls="-", c="green")
         
         # plt.plot(bins_id[:-1], bin_probs_id, color='g', label='ID Probs')
         plt.plot(bins[:-1], bin_probs, color='r', label='OOD Probs')
 
-        gmm = GMM(n_components=3).fit(weight_ood.reshape(-1, 1))
+        # a 3-mode 1D mixture is well determined by a subsample
+        weight_ood_col = weight_ood.reshape(-1, 1)
+        if len(weight_ood_col) > args.gmm_fit_size:
+            gmm.fit(rng.choice(weight_ood_col, args.gmm_fit_size, replace=False))
+        else:
+            gmm.fit(weight_ood_col)
+        # after the cold first fit, warm-started refits only need a few EM steps
+        gmm.max_iter = 20
         m_g = gmm.means_
         c_g  = gmm.covariances_
         w_g = gmm.weights_
 
         g_seq = np.argsort(m_g, axis=0).squeeze()
-        
-        m1 = float(m_g[g_seq[0]][0])
-        s1 = np.sqrt(float(c_g[g_seq[0]][0][0]))
-        w1 = w_g[g_seq[0]]
-
-        m2 = float(m_g[g_seq[1]][0])
-        s2 = np.sqrt(float(c_g[g_seq[1]][0][0]))
-        w2 = w_g[g_seq[1]]
 
-        m3 = float(m_g[g_seq[2]][0])
-        s3 = np.sqrt(float(c_g[g_seq[2]][0][0]))
-        w3 = w_g[g_seq[2]]
+        # components sorted by mean
+        means = m_g[g_seq, 0]
+        sigmas = np.sqrt(c_g[g_seq, 0, 0])
+        weights = w_g[g_seq]
 
-        estimated_bin_probs_c1 = norm.cdf(bins[1:], m1, s1) - norm.cdf(bins[:-1], m1, s1)
-        estimated_bin_probs_c2 = norm.cdf(bins[1:], m2, s2) - norm.cdf(bins[:-1], m2, s2)
-        estimated_bin_probs_c3 = norm.cdf(bins[1:], m3, s3) - norm.cdf(bins[:-1], m3, s3)
-        estimated_bin_probs_g = estimated_bin_probs_c1 * w1 + estimated_bin_probs_c2 * w2 +  estimated_bin_probs_c3 * w3
+        # normal CDF of all 3 components at every bin edge in one vectorized call
+        cdfs = ndtr((bins[None, :] - means[:, None]) / sigmas[:, None])
+        estimated_bin_probs_c = np.diff(cdfs, axis=1)
+        estimated_bin_probs_g = weights @ estimated_bin_probs_c
 
-        estimated_bin_probs_c1 = [float(estimated_bin_prob_c1) / sum(estimated_bin_probs_c1) for estimated_bin_prob_c1 in estimated_bin_probs_c1] # normalize
-        estimated_bin_probs_c2 = [float(estimated_bin_prob_c2) / sum(estimated_bin_probs_c2) for estimated_bin_prob_c2 in estimated_bin_probs_c2] # normalize
-        estimated_bin_probs_c3 = [float(estimated_bin_prob_c3) / sum(estimated_bin_probs_c3) for estimated_bin_prob_c3 in estimated_bin_probs_c3] # normalize
-        # estimated_bin_probs_g2_adj = [float(estimated_bin_prob_g2_adj) / sum(estimated_bin_probs_g2_adj) for estimated_bin_prob_g2_adj in estimated_bin_probs_g2_adj] # normalize
-        estimated_bin_probs_g = [float(estimated_bin_prob_g) / sum(estimated_bin_probs_g) for estimated_bin_prob_g in estimated_bin_probs_g] # normalize
+        estimated_bin_probs_c /= estimated_bin_probs_c.sum(axis=1, keepdims=True) # normalize
+        estimated_bin_probs_g /= estimated_bin_probs_g.sum() # normalize
+        estimated_bin_probs_c1, estimated_bin_probs_c2, estimated_bin_probs_c3 = estimated_bin_probs_c
 
         # plt.plot(bins[:-1], estimated_bin_probs_g1, color='orange', label='OOD GMM-1')
         plt.plot(bins[:-1], estimated_bin_probs_c1, color='k', linestyle='dashed', alpha=0.5, label='OOD GMM-1')
@@ -215,6 +261,8 @@ def visualize_weight(data_loader_id, data_loader_ood, clf):
     # save the figure
     fig_path = Path('./imgs') / args.fig_name
     plt.savefig(str(fig_path))
+    # release the canvas, pyplot keeps a reference to every open figure
+    plt.close(fig)
 
 def main(args):
 
@@ -225,7 +273,7 @@ def main(args):
     
     test_trf_ood = get_ood_trf(args.id, 'tiny_images', 'test')
     test_all_set_ood = get_ds(root=args.data_dir, ds_name='tiny_images', split='wo_cifar', transform=test_trf_ood)
-    indices_sampled_ood = torch.randperm(len(test_all_set_ood))[:int(args.sampled_ood_size_factor * len(test_set_id))].tolist()
+    indices_sampled_ood = np.random.default_rng(args.seed).choice(len(test_all_set_ood), int(args.sampled_ood_size_factor * len(test_set_id)), replace=False).tolist()
     test_set_ood = Subset(test_all_set_ood, indices_sampled_ood)
     test_loader_ood = DataLoader(test_set_ood, batch_size=args.sampled_ood_size_factor * args.batch_size, shuffle=True, num_workers=args.prefetch, pin_memory=True)
 
@@ -238,8 +286,14 @@ def main(args):
     else:
         raise RuntimeError('<<< Invalid score: '.format(args.score))
     
-    clf = nn.DataParallel(clf)
-    visualize_weight(test_loader_id, test_loader_ood, clf)
+    # scoring is inference only, a single device replaces the DataParallel scatter / gather
+    torch.cuda.set_device(int(args.gpu_idx))
+    # the same fixed ID / OOD sets are scored for every checkpoint with the deterministic test transform:
+    # decode & transform once, then replay the GPU resident batches
+    test_loader_id = cache_gpu_batches(test_loader_id)
+    test_loader_ood = cache_gpu_batches(test_loader_ood)
+    amp_dtype, _ = get_amp(args.amp)
+    visualize_weight(test_loader_id, test_loader_ood, clf, amp_dtype)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='detect ood')
@@ -254,6 +308,11 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', type=str, default='./outputs')
     parser.add_argument('--sampled_ood_size_factor', type=int, default=5)
     parser.add_argument('--fig_name', type=str, default='test.png')
+    parser.add_argument('--plot_every', type=int, default=1, help='visualize every n-th of the 100 checkpoints')
+    parser.add_argument('--subplot_size', type=float, default=2.0, help='subplot width / height in inches')
+    parser.add_argument('--dpi', type=int, default=75)
+    parser.add_argument('--gmm_fit_size', type=int, default=65536, help='max number of OOD weights the GMM is fit on')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'auto', 'fp16', 'bf16'], help='mixed precision scoring')
     parser.add_argument('--gpu_idx', type=int, default=0)
 
     args = parser.parse_args()